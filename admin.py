@@ -1,4 +1,5 @@
 from django.contrib import admin
+from plugins.eschol import logic
 from plugins.eschol.models import (JournalUnit,
                                    EscholArticle,
                                    IssuePublicationHistory,
@@ -9,8 +10,16 @@ class JournalUnitAdmin(admin.ModelAdmin):
 
 class EscholArticleAdmin(admin.ModelAdmin):
     search_fields = ('article__title',)
-    list_filter = ('article__journal',)
+    list_display = ('article', 'ark', 'is_doi_registered', 'doi_pending', 'doi_attempts')
+    list_filter = ('article__journal', 'is_doi_registered', 'doi_pending')
     raw_id_fields = ('article',)
+    actions = ['queue_doi_registration']
+
+    @admin.action(description="Queue DOI registration")
+    def queue_doi_registration(self, request, queryset):
+        for epub in queryset:
+            logic.queue_doi_registration(epub)
+        self.message_user(request, f"DOI registration queued for {queryset.count()} articles")
 
 class ArticlePublicationHistoryAdmin(admin.ModelAdmin):
     raw_id_fields = ('article',)
@@ -0,0 +1,163 @@
+import os, resource, shutil, uuid
+from datetime import datetime
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
+
+from core.files import save_file
+from core.models import Galley, SupplementaryFile
+from journal.models import Issue
+from journal.tests.utils import make_test_journal
+from press.models import Press
+from submission.models import STAGE_PUBLISHED, Article, FrozenAuthor
+from utils.testing import helpers
+
+from plugins.eschol import client, logic, metrics
+
+# Builds synthetic journals and times publishing their issues, see the
+# benchmark_publication command.  Articles cycle through an XML render galley
+# (rendered to HTML), a PDF galley and a remote galley.
+JATS = """<?xml version="1.0" encoding="UTF-8"?>
+<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article">
+<front><article-meta><title-group><article-title>{title}</article-title></title-group>
+</article-meta></front>
+<body>{body}</body>
+</article>
+"""
+PARAGRAPH = "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod " \
+            "tempor incididunt ut labore et dolore magna aliqua.</p>"
+GALLEY_TYPES = ("xml", "pdf", "remote")
+
+def peak_rss():
+    """High water mark of this process's resident memory in KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def current_rss():
+    """This process's resident memory in KB, None where /proc isn't available"""
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, IndexError, ValueError):
+        return None
+
+def get_xml(article, xml_file=None, paragraphs=50):
+    if xml_file:
+        with open(xml_file, "rb") as f:
+            return f.read()
+    return JATS.format(title=article.title, body=PARAGRAPH * paragraphs).encode("utf-8")
+
+def add_galley(request, article, galley_type, images=1, xml_file=None):
+    if galley_type == "remote":
+        galley = Galley.objects.create(article=article,
+                                       label="PDF",
+                                       type="pdf",
+                                       is_remote=True,
+                                       remote_file=f"https://example.org/{article.pk}.pdf")
+        article.render_galley = galley
+        return
+
+    if galley_type == "xml":
+        upload = SimpleUploadedFile(f"{article.pk}.xml", get_xml(article, xml_file))
+    else:
+        upload = SimpleUploadedFile(f"{article.pk}.pdf", b"%PDF-1.4\n" + b"0" * 65536)
+    f = save_file(request, upload, label=galley_type.upper(), public=True,
+                  path_parts=('articles', article.pk))
+    galley = helpers.create_galley(article, file_obj=f)
+    for i in range(images):
+        img = save_file(request, SimpleUploadedFile(f"figure{i}.png", b"\x89PNG" + b"0" * 4096),
+                        label=f"Figure {i}", public=True, path_parts=('articles', article.pk))
+        galley.images.add(img)
+    if galley_type == "xml":
+        article.render_galley = galley
+
+def build_issue(request, journal, size, number, authors=20, supp_files=1, images=1, xml_file=None):
+    d = timezone.now()
+    articles = []
+    for i in range(size):
+        a = helpers.create_article(journal,
+                                   with_author=False,
+                                   date_published=d,
+                                   stage=STAGE_PUBLISHED,
+                                   language=None)
+        a.title = f"Benchmark article {number}.{i + 1}"
+        a.owner = request.user
+        FrozenAuthor.objects.bulk_create([FrozenAuthor(article=a,
+                                                       first_name=f"Author{j}",
+                                                       last_name=f"Benchmark{i}",
+                                                       institution="University of Benchmarks",
+                                                       order=j)
+                                          for j in range(authors)])
+        add_galley(request, a, GALLEY_TYPES[i % len(GALLEY_TYPES)], images, xml_file)
+        for j in range(supp_files):
+            f = save_file(request, SimpleUploadedFile(f"data{j}.csv", b"a,b\n1,2\n" * 512),
+                          label=f"Data {j}", public=True, path_parts=('articles', a.pk))
+            a.supplementary_files.add(SupplementaryFile.objects.create(file=f, label=f"Data {j}"))
+        a.save()
+        articles.append(a)
+
+    issue = helpers.create_issue(journal, articles=articles)
+    issue.volume = 1
+    issue.issue = str(number)
+    issue.save()
+    for a in articles:
+        a.primary_issue = issue
+        a.save()
+    return issue
+
+def build_journal(sizes, **kwargs):
+    """Creates a journal with an issue of each size, returns (journal, issues)"""
+    code = f"bench{uuid.uuid4().hex[:8]}"
+    if not Press.objects.exists():
+        helpers.create_press()
+    journal = make_test_journal(code=code, domain=f"{code}.invalid")
+    request = helpers.Request()
+    request.user = helpers.create_user(f"{code}@example.org")
+    issues = [build_issue(request, journal, size, number, **kwargs)
+              for number, size in enumerate(sizes, start=1)]
+    return journal, issues
+
+def delete_journal(journal):
+    articles = Article.objects.filter(journal=journal)
+    for pk in articles.values_list("pk", flat=True):
+        shutil.rmtree(os.path.join(settings.BASE_DIR, 'files', 'articles', str(pk)),
+                      ignore_errors=True)
+    articles.delete()
+    Issue.objects.filter(journal=journal).delete()
+    journal.delete()
+
+def publish_issue(issue, workers=1, batch_size=1, force=True):
+    """Publishes an issue and returns what was measured.
+
+    The process's peak RSS includes everything run before, e.g. building the
+    journal, so the growth of the peak and of the current RSS during the
+    publish are reported instead.  Queries are only counted on this thread's
+    connection, so they are None with more than one worker.
+    """
+    handshakes = client.pool_stats()["handshakes"]
+    peak_before = peak_rss()
+    rss_before = current_rss()
+    with metrics.collecting() as queries, metrics.counting_queries():
+        start = default_timer()
+        ipub = logic.issue_to_eschol(issue=issue,
+                                     force=force,
+                                     workers=workers,
+                                     batch_size=batch_size)
+        elapsed = default_timer() - start
+    rss_after = current_rss()
+    counted = workers <= 1
+    n = ipub.articlepublicationhistory_set.count()
+    timings = ipub.timings or {}
+    return {"issue": issue.pk,
+            "articles": n,
+            "successful": ipub.articlepublicationhistory_set.filter(success=True).count(),
+            "wall_time": round(elapsed, 3),
+            "articles_per_second": round(n / elapsed, 3) if elapsed else None,
+            "queries": queries.get("queries", 0) if counted else None,
+            "query_time": round(queries.get("query_time", 0), 3) if counted else None,
+            "connections_opened": client.pool_stats()["handshakes"] - handshakes,
+            "peak_rss_growth_kb": peak_rss() - peak_before,
+            "rss_growth_kb": rss_after - rss_before if rss_after is not None else None,
+            "stages": timings.get("stages", {}),
+            "date": datetime.now().isoformat()}
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from plugins.eschol.models import CircuitBreaker
+
+from utils.logger import get_logger
+logger = get_logger(__name__)
+
+# Circuit breaker around the eScholarship API, shared by every worker.
+# After ESCHOL_CIRCUIT_FAILURE_THRESHOLD failures in a row that look like an
+# outage (timeouts, connection errors, 5xx) the circuit opens and calls fail
+# without being sent.  Once ESCHOL_CIRCUIT_RESET_TIMEOUT seconds have passed
+# one call is let through as a probe: if it gets an answer the circuit closes,
+# if it fails the circuit stays open for another timeout.
+NAME = "eschol"
+
+def get_threshold():
+    return getattr(settings, "ESCHOL_CIRCUIT_FAILURE_THRESHOLD", 5)
+
+def get_reset_timeout():
+    return getattr(settings, "ESCHOL_CIRCUIT_RESET_TIMEOUT", 60)
+
+def get_remaining(since, now=None):
+    now = now or timezone.now()
+    return max(get_reset_timeout() - (now - since).total_seconds(), 0)
+
+def allow():
+    """Returns 0 if a call can be made, otherwise the seconds until the
+    circuit lets a probe through"""
+    if not get_threshold():
+        return 0
+    breaker = CircuitBreaker.objects.filter(name=NAME).first()
+    if not breaker or breaker.state == CircuitBreaker.CLOSED:
+        return 0
+
+    with transaction.atomic():
+        breaker = CircuitBreaker.objects.select_for_update().get(pk=breaker.pk)
+        if breaker.state == CircuitBreaker.CLOSED:
+            return 0
+        now = timezone.now()
+        # a probe that never reported back (its worker died) is replaced
+        # after another timeout
+        since = breaker.probe_started if breaker.state == CircuitBreaker.HALF_OPEN \
+                                      else breaker.opened
+        remaining = get_remaining(since, now)
+        if remaining:
+            return remaining
+        breaker.state = CircuitBreaker.HALF_OPEN
+        breaker.probe_started = now
+        breaker.save()
+    logger.info("eScholarship API circuit half open, sending a probe")
+    return 0
+
+def record_success():
+    if not get_threshold():
+        return
+    closed = CircuitBreaker.objects.filter(name=NAME)\
+                                   .exclude(state=CircuitBreaker.CLOSED, failures=0)\
+                                   .update(state=CircuitBreaker.CLOSED,
+                                           failures=0,
+                                           opened=None,
+                                           probe_started=None)
+    if closed:
+        logger.info("eScholarship API circuit closed")
+
+def record_failure(reason):
+    threshold = get_threshold()
+    if not threshold:
+        return
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                breaker, _ = CircuitBreaker.objects.select_for_update().get_or_create(name=NAME)
+                breaker.failures += 1
+                if breaker.state == CircuitBreaker.HALF_OPEN or \
+                   (breaker.state == CircuitBreaker.CLOSED and breaker.failures >= threshold):
+                    breaker.state = CircuitBreaker.OPEN
+                    breaker.opened = timezone.now()
+                    breaker.probe_started = None
+                    logger.error(f"eScholarship API circuit opened after {breaker.failures} "
+                                 f"failures: {reason}")
+                breaker.save()
+            return
+        except IntegrityError:
+            # another process created the breaker first
+            continue
+
+def stats():
+    breaker = CircuitBreaker.objects.filter(name=NAME).first()
+    if not breaker:
+        return {"state": "Closed", "failures": 0, "retry_in": None}
+    retry_in = None
+    if breaker.state == CircuitBreaker.OPEN:
+        retry_in = int(get_remaining(breaker.opened))
+    return {"state": breaker.get_state_display(),
+            "failures": breaker.failures,
+            "retry_in": retry_in}
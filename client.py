@@ -0,0 +1,80 @@
+import os, threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from utils.logger import get_logger
+logger = get_logger(__name__)
+
+# one session per worker process, created lazily on first use
+# django_q forks its workers so we track the pid that created the session
+# and build a new one if we find ourselves in a different process
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+def get_timeout():
+    return (getattr(settings, "ESCHOL_CONNECT_TIMEOUT", 20),
+            getattr(settings, "ESCHOL_READ_TIMEOUT", 30))
+
+def new_session():
+    pool_size = getattr(settings, "ESCHOL_POOL_MAXSIZE", 10)
+    adapter = HTTPAdapter(pool_connections=getattr(settings, "ESCHOL_POOL_CONNECTIONS", 2),
+                          pool_maxsize=pool_size,
+                          pool_block=getattr(settings, "ESCHOL_POOL_BLOCK", False))
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session():
+    global _session, _session_pid # pylint: disable=global-statement
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                logger.debug(f"Creating eScholarship API session for process {pid}")
+                _session = new_session()
+                _session_pid = pid
+    return _session
+
+def close_session():
+    global _session, _session_pid # pylint: disable=global-statement
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pid = None
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", get_timeout())
+    return get_session().post(url, **kwargs)
+
+def pool_stats():
+    """Returns connection counters for the current process's session.
+
+    `handshakes` is the number of new connections opened (each one a
+    TCP and, for https, TLS handshake) and `reused` is the number of
+    requests that went over an already open connection.
+    """
+    stats = {"pid": os.getpid(), "pools": 0, "handshakes": 0, "requests": 0, "reused": 0}
+    if _session is None or _session_pid != os.getpid():
+        return stats
+
+    seen = set()
+    for adapter in _session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["pools"] += 1
+            stats["handshakes"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+    stats["reused"] = max(stats["requests"] - stats["handshakes"], 0)
+    return stats
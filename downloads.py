@@ -0,0 +1,120 @@
+import os, re
+from wsgiref.util import FileWrapper
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+CHUNK_SIZE = 8192
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def file_etag(mtime_ns, size):
+    # from the modification time and size like nginx, so the file isn't read
+    return f'"{mtime_ns:x}-{size:x}"'
+
+def get_range(request, size, etag, last_modified):
+    """Returns (start, end) for a satisfiable single byte range, None to send
+    the whole file or False if the range can't be satisfied"""
+    header = request.META.get("HTTP_RANGE")
+    if not header:
+        return None
+
+    # If-Range: only send part of the file if it hasn't changed
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if if_range:
+        if if_range.startswith('W/'):
+            # weak validators can't be used for ranges
+            return None
+        if if_range.startswith('"'):
+            if if_range != etag:
+                return None
+        elif parse_http_date_safe(if_range) != int(last_modified):
+            return None
+
+    m = RANGE_RE.match(header.strip())
+    if not m:
+        # multiple or malformed ranges, send everything
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    elif last:
+        # suffix range: the final N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        return None
+
+    if start >= size or start > end:
+        return False
+    return start, end
+
+def read_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def get_offload_header(article, file_object, path):
+    """Header that hands the transfer to the front end web server, if configured"""
+    prefix = getattr(settings, "ESCHOL_X_ACCEL_REDIRECT_PREFIX", None)
+    if prefix:
+        location = f"{prefix.rstrip('/')}/articles/{article.pk}/{file_object.uuid_filename}"
+        return "X-Accel-Redirect", location
+    if getattr(settings, "ESCHOL_X_SENDFILE", False):
+        return "X-Sendfile", path
+    return None
+
+def serve_article_file(request, article, file_object):
+    """Serves a file of an article with ETag/Last-Modified validators,
+    answering conditional requests with 304 and byte ranges with 206"""
+    path = os.path.join(settings.BASE_DIR, 'files', 'articles',
+                        str(article.pk), str(file_object.uuid_filename))
+    if file_object.is_remote or not os.path.isfile(path):
+        raise Http404
+
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = file_etag(stat.st_mtime_ns, size)
+    last_modified = int(stat.st_mtime)
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        not_modified["Accept-Ranges"] = "bytes"
+        return not_modified
+
+    offload = get_offload_header(article, file_object, path)
+    byte_range = None if offload else get_range(request, size, etag, last_modified)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+    elif offload:
+        # the web server sends the body and handles any Range header itself
+        response = HttpResponse(content_type=file_object.mime_type)
+        response[offload[0]] = offload[1]
+    elif byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(read_range(path, start, length),
+                                         status=206,
+                                         content_type=file_object.mime_type)
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = length
+    else:
+        response = StreamingHttpResponse(FileWrapper(open(path, 'rb'), CHUNK_SIZE), #pylint: disable=consider-using-with
+                                         content_type=file_object.mime_type)
+        response["Content-Length"] = size
+
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    if response.status_code != 416:
+        response["Content-Disposition"] = f'attachment; filename="{file_object.original_filename}"'
+    return response
@@ -1,21 +1,31 @@
-import json, os, time
+import hashlib, json, os, time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from uuid import uuid4
 
-import requests
-
 from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Min, Q
 from django.urls import reverse
 from django.contrib import messages
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils.encoding import force_bytes
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+from lxml import etree
+
+from django_q.models import Schedule
 
 from journal.models import ArticleOrdering, SectionOrdering
+from submission.models import Article, Section
 from core.models import File, XSLFile
 from core.files import PDF_MIMETYPES
 
-from plugins.eschol.models import (JournalUnit,
-                                   EscholArticle,
+from plugins.eschol import client, metrics, ratelimit, retry, unit_cache
+from plugins.eschol.models import (EscholArticle,
                                    AccessToken,
                                    ArticlePublicationHistory,
                                    IssuePublicationHistory)
@@ -24,6 +34,9 @@ from utils import logic as utils_logic
 from utils.logger import get_logger
 logger = get_logger(__name__)
 
+XML_MIMETYPES = ('application/xml', 'text/xml')
+FILE_ACCESS_SALT = "plugins.eschol.access_article_file"
+
 VALID_RIGHTS = ["https://creativecommons.org/licenses/by/4.0/",
                 "https://creativecommons.org/licenses/by-sa/4.0/",
                 "https://creativecommons.org/licenses/by-nd/4.0/",
@@ -74,46 +87,158 @@ def save_article_file(output, article, original_filename, kwargs=None):
 
     return new_file
 
-def send_to_eschol(query, variables, sleep=10):
+def send_to_eschol(query, variables, count=1):
+    """Sends a GraphQL query, retrying according to the retry policy.
+
+    `count` is the number of aliased mutations in a batch query, each takes
+    a rate limit token.
+    """
     url = settings.ESCHOL_API_URL
     params = {'access': settings.ESCHOL_ACCESS_TOKEN}
     headers = {"Privileged": settings.ESCHOL_PRIV_KEY}
-    r = requests.post(url,
-                     params=params,
-                     json={'query': query, 'variables': variables},
-                     headers=headers,
-                     timeout=(20, 30))
-    # Sometimes submit throws a deadlock error that comes back in the
-    # API text response (rather than as an error code or a proper json error message)
-    # Once we move off of submit-style backend for the API we should be able
-    # to remove this special case
-    if "Mysql2::Error: Deadlock" in r.text:
-        if sleep < getattr(settings, "ESCHOL_SLEEP_MAX", 100):
-            logger.info("Encountered eScholarship deadlock retrying...")
-            time.sleep(sleep)
-            # If we're repeatedly getting deadlock errors increase the sleep time
-            r = send_to_eschol(query, variables, sleep=sleep * 2)
-        else:
-            logger.error(f"Deadlock sleep max reached: {variables}")
-    return r
+    kind = ratelimit.get_query_kind(query)
+
+    def post():
+        ratelimit.acquire(kind, count)
+        return client.post(url,
+                           params=params,
+                           json={'query': query, 'variables': variables},
+                           headers=headers)
+
+    return retry.call(post)
 
 def get_provisional_id(article):
     if hasattr(settings, 'ESCHOL_API_URL'):
         variables = {"input": {"sourceName": "janeway", "sourceID": str(article.pk)}}
-        r = send_to_eschol(MINT_QUERY, variables)
+        with metrics.timer("mint"):
+            r = send_to_eschol(MINT_QUERY, variables)
         data = json.loads(r.text)
         return data["data"]["mintProvisionalID"]["id"]
 
     # Return a fake ark if we're not connected to the API
     return "ark:/13030/qtXXXXXXXX"
 
+def get_batch_mint_query(aliases):
+    params = ", ".join([f"${a}: MintProvisionalIDInput!" for a in aliases])
+    fields = "".join([f"""    {a}: mintProvisionalID(input: ${a}) {{
+        id
+    }}
+""" for a in aliases])
+    return f"mutation mintProvisionalIDs({params}) {{\n{fields}}}\n"
+
+def mint_batch(articles):
+    """Mints provisional ids for articles in one request, returns a dict of article pk to ark"""
+    aliases = {f"article{a.pk}": a for a in articles}
+    variables = {alias: {"sourceName": "janeway", "sourceID": str(a.pk)}
+                 for alias, a in aliases.items()}
+    arks = {}
+    try:
+        with metrics.timer("mint"):
+            r = send_to_eschol(get_batch_mint_query(list(aliases)), variables,
+                               count=len(aliases))
+        data = json.loads(r.text)
+        for alias, a in aliases.items():
+            result = (data.get("data") or {}).get(alias)
+            if result:
+                arks[a.pk] = result["id"]
+            else:
+                logger.error(f"Could not mint provisional id for {a}: {data.get('errors')}")
+    except retry.RetryDeferred:
+        raise
+    except Exception as e: #pylint: disable=broad-exception-caught
+        # arks that aren't minted here will be minted when the article is rendered
+        logger.error(f"Could not mint provisional ids for {len(articles)} articles: {e}")
+    return arks
+
+def mint_provisional_ids(articles):
+    """Mints arks for any articles without an EscholArticle in aliased batches
+    and bulk creates their EscholArticles.  Returns the new EscholArticles."""
+    existing = set(EscholArticle.objects.filter(article__in=articles)\
+                                        .values_list('article_id', flat=True))
+    articles = [a for a in articles if a.pk not in existing]
+    batch_size = max(int(getattr(settings, "ESCHOL_MINT_BATCH_SIZE", 50)), 1)
+    arks = {}
+    for i in range(0, len(articles), batch_size):
+        arks.update(mint_batch(articles[i:i + batch_size]))
+
+    # check again in case an EscholArticle was created while we were minting
+    existing = set(EscholArticle.objects.filter(article_id__in=arks.keys())\
+                                        .values_list('article_id', flat=True))
+    return EscholArticle.objects.bulk_create([EscholArticle(article_id=pk, ark=ark)
+                                              for pk, ark in arks.items()
+                                              if pk not in existing])
+
+def needs_provisional_id(article):
+    """True if the article's render galley is XML which needs an ark to render"""
+    rg = article.get_render_galley
+    return bool(rg and rg.public and not rg.is_remote and rg.file
+                and rg.file.mime_type in XML_MIMETYPES)
+
+def premint_arks(articles):
+    """Mints arks up front for all articles that will need one while
+    rendering so that no API calls are made during HTML generation"""
+    articles = [a for a in articles if needs_provisional_id(a)]
+    if not articles:
+        return []
+    epubs = mint_provisional_ids(articles)
+    logger.info(f"Minted {len(epubs)} provisional ids")
+    return epubs
+
+def get_file_access_signature(article_id, file_id, expires):
+    value = f"{article_id}:{file_id}:{expires}"
+    return salted_hmac(FILE_ACCESS_SALT, value, algorithm="sha256").hexdigest()
+
+def sign_file_access(article_id, file_id, expires=None):
+    """Returns an `access` value for a file that expires after ESCHOL_FILE_LINK_TTL seconds"""
+    if expires is None:
+        expires = int(time.time()) + getattr(settings, "ESCHOL_FILE_LINK_TTL", 86400)
+    return f"{expires}.{get_file_access_signature(article_id, file_id, expires)}"
+
+def check_file_access(article_id, file_id, access):
+    """Checks a signed `access` value without touching the database"""
+    if not access or "." not in access:
+        return False
+    expires, signature = access.split(".", 1)
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = get_file_access_signature(article_id, file_id, int(expires))
+    return constant_time_compare(signature, expected)
+
+def get_access_token_cutoff():
+    """AccessTokens issued before this date have expired"""
+    return (datetime.now() - timedelta(days=1)).date()
+
+def purge_expired_access_tokens(batch_size=None):
+    """Deletes expired AccessTokens in batches, returns the number deleted.
+
+    Run it from a django_q schedule or the purge_access_tokens command.
+    """
+    if not batch_size:
+        batch_size = getattr(settings, "ESCHOL_TOKEN_PURGE_BATCH_SIZE", 1000)
+    expired = AccessToken.objects.filter(date__lt=get_access_token_cutoff())
+    total = 0
+    while True:
+        ids = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted, _ = AccessToken.objects.filter(pk__in=ids).delete()
+        total += deleted
+    logger.info(f"Purged {total} expired access tokens")
+    return total
+
+def get_file_token(article, fid):
+    with metrics.timer("token"):
+        if getattr(settings, "ESCHOL_SIGNED_FILE_LINKS", True):
+            return sign_file_access(article.pk, fid)
+        token = AccessToken(article_id=article.pk, file_id=fid)
+        token.generate_token()
+        return token.token
+
 def get_file_url(article, fid):
-    token = AccessToken.objects.create(article_id=article.pk, file_id=fid)
-    token.generate_token()
     url = article.journal.site_url(path=reverse('access_article_file',
                                    kwargs={"article_id": article.pk,
                                            "file_id": fid}))
-    return f"{url}?access={token.token}"
+    return f"{url}?access={get_file_token(article, fid)}"
 
 def get_supp_file_json(f, article, filename=None, title=None):
     x = {"file": filename if filename else f.original_filename,
@@ -138,24 +263,103 @@ def convert_data_availability(d):
             return types.get(f.answer, None)
     return None
 
-def xml_galley_to_html(article, galley, epub):
-    item = {}
-    supp_files = []
+XML_DECLARATION = b'<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n'
+
+def normalize_html_lxml(s):
+    """Parses HTML and writes it out as formatted XHTML, equivalent to
+    `xmllint --html --xmlout --format --encode utf-8`"""
+    parser = etree.HTMLParser(encoding="utf-8", remove_blank_text=True)
+    tree = etree.fromstring(s, parser).getroottree()
+    # xmllint writes script and style content as CDATA rather than escaping it
+    for el in tree.iter("script", "style"):
+        if el.text and "]]>" not in el.text:
+            el.text = etree.CDATA(el.text)
+    return XML_DECLARATION + etree.tostring(tree,
+                                            method="xml",
+                                            encoding="utf-8",
+                                            pretty_print=True,
+                                            doctype=tree.docinfo.doctype)
+
+def normalize_html_xmllint(s):
+    with Popen(['xmllint', '--html', '--xmlout', '--format', '--encode', 'utf-8', '/dev/stdin'],
+              stdin=PIPE,
+              stdout=PIPE,
+              stderr=PIPE) as p:
+        (output, error_output) = p.communicate(s)
+    if p.returncode != 0 or not output:
+        raise RuntimeError(f"xmllint failed ({p.returncode}): "
+                           f"{error_output.decode(errors='replace')}")
+    return output
+
+HTML_NORMALIZERS = {"lxml": normalize_html_lxml,
+                    "xmllint": normalize_html_xmllint}
+
+def normalize_html(s, backend=None):
+    backend = backend or getattr(settings, "ESCHOL_HTML_NORMALIZER", "lxml")
+    return HTML_NORMALIZERS[backend](s)
+
+# increment when the escholarship.html template or the way it's rendered
+# changes so that cached HTML is regenerated
+HTML_TEMPLATE_VERSION = 1
+
+def set_default_xsl_file(galley):
     # if the galley doesn't have an xsl file it will cause an error when rendering
     # so set it to the default
     if not galley.xsl_file:
         galley.xsl_file = XSLFile.objects.get(label=settings.DEFAULT_XSL_FILE_LABEL)
         galley.save()
 
+def render_galley_html(article, galley):
+    """Renders an XML galley into the escholarship HTML template, returns utf-8 bytes"""
+    set_default_xsl_file(galley)
     context = {'article_content': galley.render(recover=True),
                'default_css_url': get_default_css_url(article.journal),
                'css_file': galley.css_file}
     r = render_to_string("eschol/escholarship.html", context)
-    s = force_bytes(r,  encoding="utf-8")
-    with Popen(['xmllint', '--html', '--xmlout', '--format', '--encode', 'utf-8', '/dev/stdin'],
-              stdin=PIPE,
-              stdout=PIPE) as p:
-        (output, _error_output) = p.communicate(s)
+    return force_bytes(r,  encoding="utf-8")
+
+def get_file_path(f):
+    return os.path.join(settings.BASE_DIR, 'files', 'articles', str(f.article_id),
+                        str(f.uuid_filename))
+
+def file_checksum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_html_cache_key(article, galley):
+    """Returns a key for the generated HTML of a galley built from everything that goes into it"""
+    set_default_xsl_file(galley)
+    with galley.xsl_file.file.open('rb') as f:
+        xsl_checksum = hashlib.sha256(f.read()).hexdigest()
+    css = galley.css_file
+    css_checksum = None
+    if css:
+        css_checksum = css.remote_url if css.is_remote else file_checksum(get_file_path(css))
+    parts = [HTML_TEMPLATE_VERSION,
+             getattr(settings, "ESCHOL_HTML_NORMALIZER", "lxml"),
+             galley.pk,
+             file_checksum(get_file_path(galley.file)),
+             xsl_checksum,
+             str(css) if css else None,
+             css_checksum,
+             get_default_css_url(article.journal)]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+def get_cached_html_file(epub, key, html_filename):
+    if epub.html_cache_key != key:
+        return None
+    html_file = File.objects.filter(original_filename=html_filename,
+                                    article_id=epub.article_id).first()
+    if html_file and os.path.exists(get_file_path(html_file)):
+        return html_file
+    return None
+
+def xml_galley_to_html(article, galley, epub):
+    item = {}
+    supp_files = []
     if not epub:
         ark = get_provisional_id(article)
         epub = EscholArticle.objects.create(article=article, ark=ark)
@@ -164,14 +368,28 @@ def xml_galley_to_html(article, galley, epub):
 
     short_ark = ark.split("/")[-1]
     html_filename = f"{short_ark}.html"
-    html_files = File.objects.filter(original_filename=html_filename, article_id=article.id)
-    if html_files.exists():
-        html_files.delete()
-    kwargs = {'mime_type': "text/html",
-              'owner': article.owner,
-              'label': "Generated HTML",
-              'description': "HTML file generated from JATS for eschol"}
-    html_file = save_article_file(output, article, html_filename, kwargs=kwargs)
+    key = get_html_cache_key(article, galley)
+    html_file = get_cached_html_file(epub, key, html_filename)
+    if html_file:
+        logger.debug(f"Using cached HTML for {article}: {html_file.uuid_filename}")
+    else:
+        with metrics.timer("xslt"):
+            output = render_galley_html(article, galley)
+        with metrics.timer("normalize"):
+            output = normalize_html(output)
+        with metrics.timer("file_write"):
+            html_files = File.objects.filter(original_filename=html_filename, article_id=article.id)
+            if html_files.exists():
+                html_files.delete()
+            kwargs = {'mime_type': "text/html",
+                      'owner': article.owner,
+                      'label': "Generated HTML",
+                      'description': "HTML file generated from JATS for eschol"}
+            html_file = save_article_file(output, article, html_filename, kwargs=kwargs)
+        # update rather than save so date_published isn't touched
+        EscholArticle.objects.filter(pk=epub.pk).update(html_cache_key=key)
+        epub.html_cache_key = key
+
     item.update({"id": ark,
                  "contentLink": get_file_url(article, html_file.pk),
                  "contentFileName": html_file.original_filename,})
@@ -199,19 +417,118 @@ def xml_galley_to_html(article, galley, epub):
 
     return item, supp_files, epub
 
-def get_escholarticle(article):
-    epubs = EscholArticle.objects.filter(article=article)
-    if epubs.count() == 0:
+def get_escholarticle(article, epubs=None):
+    if epubs is None:
+        epubs = EscholArticle.objects.filter(article=article)
+    epubs = sorted(epubs, key=lambda e: e.pk)
+    if len(epubs) == 0:
         return None
-    if epubs.count() > 1:
+    if len(epubs) > 1:
         msg = f"Multiple EscholArticles found for {article}"
         logger.error(msg)
-    return epubs.first()
+    return epubs[0]
+
+def is_prefetched(obj, name):
+    return name in getattr(obj, '_prefetched_objects_cache', {})
+
+def get_field_answers(article, name):
+    answers = article.fieldanswer_set.all()
+    if not is_prefetched(article, 'fieldanswer_set'):
+        answers = answers.select_related('field')
+    return [a for a in answers if a.field and a.field.name == name]
+
+def get_frozen_authors(article):
+    if is_prefetched(article, 'frozenauthor_set'):
+        return article.frozenauthor_set.all()
+    return article.frozen_authors().all()
+
+def get_pdf_galley(article):
+    """Returns the first public PDF galley by sequence"""
+    if is_prefetched(article, 'galley_set'):
+        pdfs = [g for g in article.galley_set.all()
+                if g.public and g.file and g.file.mime_type == "application/pdf"]
+        return min(pdfs, key=lambda g: g.sequence) if pdfs else None
+    return article.galley_set.filter(file__mime_type="application/pdf", public=True)\
+                             .order_by("sequence",).first()
+
+def get_issue_ordering(issue):
+    """Builds the orderInSection index for every article in an issue.
+
+    Returns the issue pk and, for each article pk, a tuple of (section
+    order, article order, section article count).  Explicit SectionOrdering
+    and ArticleOrdering rows are used where they exist, otherwise the
+    position in issue.get_sorted_articles().
+    """
+    section_orders = {o.section_id: o.order for o in SectionOrdering.objects.filter(issue=issue)}
+    article_orders = {(o.section_id, o.article_id): o.order
+                      for o in ArticleOrdering.objects.filter(issue=issue)}
+
+    sections = []
+    section_articles = {}
+    for pk, section_id in issue.get_sorted_articles().values_list('pk', 'section_id'):
+        if section_id not in section_articles:
+            sections.append(section_id)
+            section_articles[section_id] = []
+        if pk not in section_articles[section_id]:
+            section_articles[section_id].append(pk)
+
+    counts = {s.pk: s.article_count() for s in Section.objects.filter(pk__in=sections)}
+
+    index = {}
+    for i, section_id in enumerate(sections):
+        sorder = section_orders.get(section_id, i) + 1
+        for j, pk in enumerate(section_articles[section_id]):
+            aorder = article_orders.get((section_id, pk), j) + 1
+            index[pk] = (sorder, aorder, counts.get(section_id, 0))
+    return {"issue": issue.pk, "articles": index}
+
+def get_article_order(article, issue, ordering=None):
+    """Returns (section order, article order, section article count) for an article.
+
+    Without an ordering for the issue the article is looked up on its own,
+    building the whole issue's index only pays off for many of its articles.
+    """
+    if ordering and ordering["issue"] == issue.pk and article.pk in ordering["articles"]:
+        return ordering["articles"][article.pk]
+    # no ordering, or not one of the issue's sorted articles, e.g. not yet published
+    return lookup_article_order(article, issue)
+
+def lookup_article_order(article, issue):
+    if SectionOrdering.objects.filter(issue=issue, section=article.section).exists():
+        sorder = SectionOrdering.objects.get(issue=issue, section=article.section).order + 1
+    else:
+        sorder = list(
+            issue.get_sorted_articles()\
+                .values_list('section__pk', flat=True)\
+                .distinct()
+        ).index(article.section.pk) + 1
+    if ArticleOrdering.objects.filter(issue=issue,
+                                      section=article.section,
+                                      article=article).exists():
+        aorder = ArticleOrdering.objects.get(issue=issue,
+                                             section=article.section,
+                                             article=article).order + 1
+    else:
+        aorder = list(
+            issue.get_sorted_articles()\
+                .filter(section=article.section)\
+                .values_list('pk', flat=True)
+        ).index(article.pk) + 1
+    return sorder, aorder, article.section.article_count()
+
+def get_article_ordering(article, ordering=None):
+    """An ordering with just this article, so the several parts of one deposit
+    that need its order only look it up once"""
+    issue = article.issue
+    if not issue:
+        return ordering
+    return {"issue": issue.pk,
+            "articles": {article.pk: get_article_order(article, issue, ordering)}}
 
-def get_article_json(article, unit):
+def get_article_json(article, unit, ordering=None):
     source_name = "janeway"
     source_id = article.pk
-    epub = get_escholarticle(article)
+    epub = get_escholarticle(article, article.escholarticle_set.all())
 
     if epub and epub.source_name:
         source_name = epub.source_name
@@ -262,14 +579,23 @@ def get_article_json(article, unit):
     if article.language:
         item["language"] = article.language
 
+    issue = article.issue
+    order = get_article_order(article, issue, ordering) if issue else None
+
     if article.section:
-        if article.section.plural and article.section.article_count() > 1:
+        if article.section.plural and order:
+            section_count = order[2]
+        elif article.section.plural:
+            section_count = article.section.article_count()
+        else:
+            section_count = 0
+        if section_count > 1:
             h = article.section.plural
         else:
             h = article.section.name
         item["sectionHeader"] =  h
 
-    keywords = list(filter(None, article.keywords.all().values_list('word', flat=True)))
+    keywords = list(filter(None, [k.word for k in article.keywords.all()]))
     if len(keywords) > 0:
         item["keywords"] = keywords
 
@@ -283,38 +609,18 @@ def get_article_json(article, unit):
     if article.publisher_name:
         item["publisher"] = article.publisher_name
 
-    data_avail_set = article.fieldanswer_set.filter(field__name="Data Availability")
-    if data_avail_set.exists():
+    data_avail_set = get_field_answers(article, "Data Availability")
+    if len(data_avail_set) > 0:
         data_avail = convert_data_availability(data_avail_set)
         if data_avail:
             item["dataAvailability"] = data_avail
             if item["dataAvailability"] == "publicRepo":
-                data_url_set = article.fieldanswer_set.filter(field__name="Data URL")
-                if data_url_set.exists():
+                data_url_set = get_field_answers(article, "Data URL")
+                if len(data_url_set) > 0:
                     item["dataURL"] = data_url_set[0].answer
 
-    issue = article.issue
     if issue:
-        if SectionOrdering.objects.filter(issue=issue, section=article.section).exists():
-            sorder = SectionOrdering.objects.get(issue=issue, section=article.section).order + 1
-        else:
-            sorder = list(
-                issue.get_sorted_articles()\
-                    .values_list('section__pk', flat=True)\
-                    .distinct()
-            ).index(article.section.pk) + 1
-        if ArticleOrdering.objects.filter(issue=issue,
-                                          section=article.section,
-                                          article=article).exists():
-            aorder = ArticleOrdering.objects.get(issue=issue,
-                                                 section=article.section,
-                                                 article=article).order + 1
-        else:
-            aorder = list(
-                issue.get_sorted_articles()\
-                    .filter(section=article.section)\
-                    .values_list('pk', flat=True)
-            ).index(article.pk) + 1
+        sorder, aorder, _ = order
         issue_vars = {"volume": str(issue.volume),
                       "issue": str(issue.issue),
                       "issueTitle": issue.issue_title,
@@ -327,7 +633,7 @@ def get_article_json(article, unit):
         item.update(issue_vars)
 
     authors = []
-    for fa in article.frozen_authors().all():
+    for fa in get_frozen_authors(article):
         if fa.is_corporate:
             parts = {"organization": fa.institution}
         else:
@@ -360,10 +666,8 @@ def get_article_json(article, unit):
 
     rg = article.get_render_galley
 
-    if not rg and article.galley_set.filter(file__mime_type="application/pdf",
-                                            public=True).exists():
-        rg = article.galley_set.filter(file__mime_type="application/pdf", public=True)\
-                               .order_by("sequence",)[0]
+    if not rg:
+        rg = get_pdf_galley(article)
 
     supp_files = []
     img_files = []
@@ -372,7 +676,7 @@ def get_article_json(article, unit):
         if rg.is_remote:
             item.update({"externalLinks": [rg.remote_file]})
         elif rg.file:
-            if rg.file.mime_type in ('application/xml', 'text/xml'):
+            if rg.file.mime_type in XML_MIMETYPES:
                 fields, supp_files, epub = xml_galley_to_html(article, rg, epub)
                 item.update(fields)
             else:
@@ -420,19 +724,60 @@ def get_article_json(article, unit):
 
     return item, epub
 
+ARTICLE_SELECT_RELATED = ('owner',
+                          'section',
+                          'license',
+                          'journal__press',
+                          'primary_issue',
+                          'render_galley__file',
+                          'render_galley__css_file')
+
+ARTICLE_PREFETCH_RELATED = ('keywords',
+                            'fieldanswer_set__field',
+                            'frozenauthor_set',
+                            'galley_set__file',
+                            'galley_set__css_file',
+                            'galley_set__images',
+                            'render_galley__images',
+                            'supplementary_files__file',
+                            'identifiers',
+                            'escholarticle_set')
+
+def prefetch_articles(articles):
+    """Loads everything get_article_json needs for a queryset of articles up front"""
+    return articles.select_related(*ARTICLE_SELECT_RELATED)\
+                   .prefetch_related(*ARTICLE_PREFETCH_RELATED)
+
+def get_issue_articles(issue):
+    return list(prefetch_articles(issue.get_sorted_articles()))
+
+def get_issue_article_json(issue, articles=None):
+    """Builds the deposit json for every article in an issue using a fixed
+    number of queries.  Returns a list of (article, item, epub)."""
+    if articles is None:
+        articles = get_issue_articles(issue)
+    unit = get_unit(issue.journal)
+    ordering = get_issue_ordering(issue)
+    results = []
+    for a in articles:
+        item, epub = get_article_json(a, unit, ordering=ordering)
+        results.append((a, item, epub))
+    return results
+
 def get_default_css_url(journal):
-    if JournalUnit.objects.filter(journal=journal).exists():
-        return JournalUnit.objects.get(journal=journal).default_css_url
-    return None
+    ju = unit_cache.get_journal_unit(journal)
+    return ju[1] if ju else None
 
 def get_unit(journal):
-    if JournalUnit.objects.filter(journal=journal).exists():
-        unit = JournalUnit.objects.get(journal=journal).unit
-    else:
-        unit = journal.code
-    return unit
+    ju = unit_cache.get_journal_unit(journal)
+    return ju[0] if ju else journal.code
 
 def register_doi(article, epub, request):
+    """Registers or updates the article's DOI with the ezid plugin.
+
+    Returns True if it succeeded, False if it failed and None if DOIs
+    aren't registered for the journal.
+    """
     try:
         # it would be better to refactor so it doesn't depend directly on ezid plugin
         from plugins.ezid.logic import register_journal_doi, update_journal_doi # pylint: disable=import-outside-toplevel
@@ -443,7 +788,11 @@ def register_doi(article, epub, request):
         if enabled:
             epub.is_doi_registered = success or epub.is_doi_registered
             epub.doi_result_text = result_text
-            epub.save()
+            # update rather than save so date_published isn't touched
+            EscholArticle.objects.filter(pk=epub.pk).update(
+                is_doi_registered=epub.is_doi_registered,
+                doi_result_text=epub.doi_result_text)
+            return bool(success)
     except (ImportError, ModuleNotFoundError):
         # If we don't find the ezid plugin just don't register.  it's fine.
         pass
@@ -452,6 +801,100 @@ def register_doi(article, epub, request):
         msg = f'An unexpected error occured when registering DOI for {article}: {e}'
         logger.error(e, exc_info=True)
         if request: messages.error(request, msg)
+        return False
+    return None
+
+DOI_TASK = "plugins.eschol.logic.register_pending_dois"
+DOI_SCHEDULE = "eschol_register_dois"
+
+def schedule_doi_registration(delay=None):
+    """Schedules the DOI registration task unless it's already due to run by then.
+
+    Waiting ESCHOL_DOI_BATCH_DELAY seconds lets the DOIs of the articles
+    deposited in the meantime be registered by the same task.
+    """
+    if delay is None:
+        delay = getattr(settings, "ESCHOL_DOI_BATCH_DELAY", 10)
+    next_run = timezone.now() + timedelta(seconds=delay)
+    if not Schedule.objects.filter(name=DOI_SCHEDULE, next_run__lte=next_run).exists():
+        Schedule.objects.create(name=DOI_SCHEDULE,
+                                func=DOI_TASK,
+                                schedule_type=Schedule.ONCE,
+                                next_run=next_run)
+
+def queue_doi_registration(epub, request=None):
+    EscholArticle.objects.filter(pk=epub.pk).update(doi_pending=True,
+                                                    doi_attempts=0,
+                                                    doi_next_attempt=None)
+    epub.doi_pending = True
+    epub.doi_attempts = 0
+    epub.doi_next_attempt = None
+    schedule_doi_registration()
+    msg = f"DOI registration queued for {epub.article}"
+    logger.info(msg)
+    if request: messages.info(request, msg)
+
+def register_pending_dois():
+    """django_q task that registers the queued DOIs that are due.
+
+    Up to ESCHOL_DOI_BATCH_SIZE DOIs are registered per run.  Failures are
+    retried with exponential backoff starting at ESCHOL_DOI_RETRY_DELAY
+    seconds, up to ESCHOL_DOI_MAX_ATTEMPTS attempts.  The task schedules
+    itself again while DOIs are still pending.
+
+    A run claims its DOIs by pushing their next attempt ESCHOL_DOI_LEASE
+    seconds out, so runs that overlap don't register the same DOIs.
+    """
+    batch_size = getattr(settings, "ESCHOL_DOI_BATCH_SIZE", 50)
+    max_attempts = getattr(settings, "ESCHOL_DOI_MAX_ATTEMPTS", 5)
+    retry_delay = getattr(settings, "ESCHOL_DOI_RETRY_DELAY", 60)
+    lease = getattr(settings, "ESCHOL_DOI_LEASE", 600)
+
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = list(EscholArticle.objects.filter(doi_pending=True)
+                                            .filter(Q(doi_next_attempt__isnull=True) |
+                                                    Q(doi_next_attempt__lte=now))
+                                            .select_for_update(skip_locked=True)
+                                            .order_by("pk")
+                                            .values_list("pk", flat=True)[:batch_size])
+        EscholArticle.objects.filter(pk__in=claimed)\
+                             .update(doi_next_attempt=now + timedelta(seconds=lease))
+    due = EscholArticle.objects.filter(pk__in=claimed)\
+                               .select_related("article", "article__journal")\
+                               .order_by("pk")
+    registered = failed = retrying = 0
+    for epub in due:
+        result = register_doi(epub.article, epub, None)
+        epub.doi_attempts += 1
+        epub.doi_next_attempt = None
+        if result is False and epub.doi_attempts < max_attempts:
+            delay = retry_delay * 2 ** (epub.doi_attempts - 1)
+            epub.doi_next_attempt = timezone.now() + timedelta(seconds=delay)
+            retrying += 1
+        else:
+            epub.doi_pending = False
+            if result is False:
+                logger.error(f"Could not register DOI for {epub.article} after "
+                             f"{epub.doi_attempts} attempts: {epub.doi_result_text}")
+                failed += 1
+            elif result:
+                registered += 1
+        # update rather than save so date_published isn't touched
+        EscholArticle.objects.filter(pk=epub.pk).update(doi_pending=epub.doi_pending,
+                                                        doi_attempts=epub.doi_attempts,
+                                                        doi_next_attempt=epub.doi_next_attempt)
+
+    pending = EscholArticle.objects.filter(doi_pending=True)
+    if pending.filter(doi_next_attempt__isnull=True).exists():
+        schedule_doi_registration(0)
+    elif pending.exists():
+        next_attempt = pending.aggregate(Min("doi_next_attempt"))["doi_next_attempt__min"]
+        schedule_doi_registration(max((next_attempt - timezone.now()).total_seconds(), 0))
+
+    msg = f"Registered {registered} DOIs, {failed} failed, {retrying} to retry"
+    logger.info(msg)
+    return msg
 
 def article_error(article, request, msg):
     logger.info(msg)
@@ -460,90 +903,452 @@ def article_error(article, request, msg):
                                                     success=False,
                                                     result=msg)
 
-def send_article(article, configured=False, request=None):
-    unit = get_unit(article.journal)
+UNCHANGED = "unchanged"
+NOT_MODIFIED = "not modified"
+
+# links that carry access credentials which change with every deposit
+ACCESS_LINK_KEYS = ("fetchLink", "contentLink")
+ACCESS_PARAMS = ("access",)
+
+def strip_access_params(url):
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k not in ACCESS_PARAMS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+def canonical_payload(value):
+    if isinstance(value, dict):
+        return {k: strip_access_params(v) if k in ACCESS_LINK_KEYS and isinstance(v, str)
+                else canonical_payload(v)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [canonical_payload(v) for v in value]
+    return value
+
+def get_payload_digest(payload):
+    """Returns a digest of a deposit payload that ignores the rotating file access tokens"""
+    s = json.dumps(canonical_payload(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+def is_unchanged(article, digest):
+    """True if the last successful deposit of the article sent the same payload"""
+    last = ArticlePublicationHistory.objects.filter(article=article, success=True)\
+                                            .exclude(payload_digest=None)\
+                                            .first()
+    return last is not None and last.payload_digest == digest
+
+def unchanged_article(article, request, digest, state_digest=None):
+    msg = f"{article} unchanged since last deposit, not sent"
+    logger.info(msg)
+    if request: messages.info(request, msg)
+    return ArticlePublicationHistory.objects.create(article=article,
+                                                    success=True,
+                                                    result=UNCHANGED,
+                                                    payload_digest=digest,
+                                                    state_digest=state_digest)
+
+def model_state(obj, exclude=()):
+    """The values of an object's concrete fields, leaving out auto_now timestamps"""
+    if obj is None:
+        return None
+    return {f.attname: getattr(obj, f.attname) for f in obj._meta.concrete_fields
+            if not getattr(f, "auto_now", False) and f.attname not in exclude}
+
+def get_article_state(article, ordering=None):
+    """Everything in the database that goes into an article's deposit"""
+    def by_pk(objs):
+        # prefetched and queried rows may come back in different orders
+        return sorted(objs, key=lambda o: o.pk)
+
+    galleys = []
+    for g in by_pk(article.galley_set.all()):
+        galleys.append({"galley": model_state(g),
+                        "file": model_state(g.file),
+                        "css_file": model_state(g.css_file),
+                        "images": [model_state(i) for i in by_pk(g.images.all())]})
+    issue = article.issue
+    return {"template": HTML_TEMPLATE_VERSION,
+            "unit": get_unit(article.journal),
+            "default_css_url": get_default_css_url(article.journal),
+            # set by deposit_success so they'd always differ from the last deposit
+            "article": model_state(article, exclude=("is_remote", "remote_url")),
+            "section": model_state(article.section),
+            "license": model_state(article.license),
+            "issue": model_state(issue),
+            "order": get_article_order(article, issue, ordering) if issue else None,
+            "galleys": galleys,
+            "supp_files": [[model_state(f), model_state(f.file)]
+                           for f in by_pk(article.supplementary_files.all())],
+            "authors": [model_state(fa) for fa in by_pk(get_frozen_authors(article))],
+            "keywords": [k.word for k in by_pk(article.keywords.all())],
+            "field_answers": [model_state(a) for a in by_pk(article.fieldanswer_set.all())],
+            "identifiers": [model_state(i) for i in by_pk(article.identifiers.all())]}
+
+def get_state_digest(article, ordering=None):
+    s = json.dumps(get_article_state(article, ordering),
+                   sort_keys=True,
+                   separators=(",", ":"),
+                   default=str)
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+def is_modified(article, state_digest):
+    """False if the article hasn't changed since its last successful deposit"""
+    last = ArticlePublicationHistory.objects.filter(article=article, success=True)\
+                                            .exclude(state_digest=None)\
+                                            .first()
+    return last is None or last.state_digest != state_digest
+
+def not_modified_article(article, request, state_digest, issue_pub=None):
+    msg = f"{article} not modified since last deposit, skipped"
+    logger.info(msg)
+    if request: messages.info(request, msg)
+    return ArticlePublicationHistory.objects.create(article=article,
+                                                    issue_pub=issue_pub,
+                                                    success=True,
+                                                    result=NOT_MODIFIED,
+                                                    state_digest=state_digest)
+
+def split_modified_articles(articles, ordering=None):
+    """Splits articles into those that are new or changed since their last
+    successful deposit and (article, state digest) for those that aren't"""
+    modified = []
+    not_modified = []
+    for a in articles:
+        state_digest = get_state_digest(a, ordering)
+        if is_modified(a, state_digest):
+            modified.append(a)
+        else:
+            not_modified.append((a, state_digest))
+    return modified, not_modified
 
+def check_article(article):
+    """Returns the reason an article can't be sent to eScholarship or None"""
     if not article.is_published:
-        return article_error(article, request, f'{article} is not published')
+        return f'{article} is not published'
 
     if article.issue is None:
-        return article_error(article, request, f'{article} published without issue')
+        return f'{article} published without issue'
 
     if not article.owner:
-        return article_error(article, request, f'{article} published without owner')
+        return f'{article} published without owner'
 
     if not article.title:
-        return article_error(article, request, f'{article} published without title')
+        return f'{article} published without title'
 
     rg = article.get_render_galley
     if rg and not rg.public:
-        return article_error(article, request, f'Private render galley selected for {article}')
+        return f'Private render galley selected for {article}'
 
-    item, epub = get_article_json(article, unit)
-    if epub:
-        item["id"] = epub.ark
+    return None
+
+def deposit_success(article, di, request=None, digest=None, state_digest=None):
+    msg = f'{di["message"]}: {di["id"]}'
+    logger.info(msg)
+    if request: messages.success(request, msg)
+    # try and get the escholarticle again in case it was created
+    epub = get_escholarticle(article)
+    if not epub:
+        epub = EscholArticle.objects.create(article=article, ark=di["id"])
+    article.is_remote = True
+    article.remote_url = epub.get_eschol_url()
+    article.save()
+    if not article.get_doi():
+        msg = f"{article} published without DOI"
+        logger.warning(msg)
+        if request: messages.warning(request, msg)
+    elif getattr(settings, "ESCHOL_REGISTER_DOIS", True):
+        with metrics.timer("doi"):
+            if getattr(settings, "ESCHOL_ASYNC_DOIS", True):
+                queue_doi_registration(epub, request)
+            else:
+                register_doi(article, epub, request)
+
+    return ArticlePublicationHistory.objects.create(article=article,
+                                                    success=True,
+                                                    payload_digest=digest,
+                                                    state_digest=state_digest)
+
+def deposit_item(article, item, request=None, force=False, state_digest=None):
+    digest = get_payload_digest(item)
+    if not force and is_unchanged(article, digest):
+        return unchanged_article(article, request, digest, state_digest)
 
     variables = {"item": item}
-    if configured:
-        try:
+    try:
+        with metrics.timer("deposit"):
             r = send_to_eschol(DEPOSIT_QUERY, variables)
 
-            data = json.loads(r.text)
-            if "data" in data:
-                di = data["data"]["depositItem"]
-                msg = f'{di["message"]}: {di["id"]}'
-                logger.info(msg)
-                if request: messages.success(request, msg)
-                # try and get the escholarticle again in case it was created
-                epub = get_escholarticle(article)
-                if not epub:
-                    epub = EscholArticle.objects.create(article=article, ark=di["id"])
-                article.is_remote = True
-                article.remote_url = epub.get_eschol_url()
-                article.save()
-                if article.get_doi():
-                    register_doi(article, epub, request)
-                else:
-                    msg = f"{article} published without DOI"
-                    logger.warning(msg)
-                    if request: messages.warning(request, msg)
-            else:
-                msg = f'ERROR sending Article {article.pk} to eScholarship: {data["errors"]}'
-                return article_error(article, request, msg)
-        except json.decoder.JSONDecodeError:
-            msg = f"An unexpected API error occured sending {article} to eScholarship"
-            apub = article_error(article, request, msg)
-            logger.error(r.text)
-            return apub
-        except Exception as e: #pylint: disable=broad-exception-caught
-            msg = f'An unexpected error occured when sending {article} to eScholarship: {e}'
-            return article_error(article, request, msg)
+        data = json.loads(r.text)
+        if "data" in data:
+            return deposit_success(article,
+                                   data["data"]["depositItem"],
+                                   request,
+                                   digest,
+                                   state_digest)
+
+        msg = f'ERROR sending Article {article.pk} to eScholarship: {data["errors"]}'
+        return article_error(article, request, msg)
+    except json.decoder.JSONDecodeError:
+        msg = f"An unexpected API error occured sending {article} to eScholarship"
+        apub = article_error(article, request, msg)
+        logger.error(r.text)
+        return apub
+    except retry.RetryDeferred:
+        raise
+    except retry.EscholAPIError as e:
+        msg = f'ERROR sending Article {article.pk} to eScholarship: {e}'
+        return article_error(article, request, msg)
+    except Exception as e: #pylint: disable=broad-exception-caught
+        msg = f'An unexpected error occured when sending {article} to eScholarship: {e}'
+        return article_error(article, request, msg)
 
+def get_deposit_item(article, ordering=None):
+    with metrics.timer("json"):
+        item, epub = get_article_json(article, get_unit(article.journal), ordering=ordering)
+    if epub:
+        item["id"] = epub.ark
+    return item
+
+METRIC_FIELDS = {"rate_limit_wait": "rate_limit_wait",
+                 "retries": "retry_count",
+                 "retry_time": "retry_time",
+                 "queries": "query_count",
+                 "query_time": "query_time"}
+# counted over a whole batch, stored as the average per article
+BATCH_AVERAGED = ("queries", "query_time")
+
+# stages of a deposit timed with metrics.timer, "other" is everything else
+TIMING_STAGES = ("json", "xslt", "normalize", "file_write", "token",
+                 "mint", "deposit", "doi", "other")
+
+def get_timings(values, n=1):
+    """Seconds spent in each stage, averaged over the n articles of a batch"""
+    timings = {stage: round(values[stage] / n, 4) for stage in TIMING_STAGES if values.get(stage)}
+    if timings:
+        timings["total"] = round(sum(timings.values()), 4)
+    return timings or None
+
+def record_metrics(apubs, values):
+    """Stores what was measured while depositing on the publication histories"""
+    fields = {field: values[name] / len(apubs) if name in BATCH_AVERAGED else values[name]
+              for name, field in METRIC_FIELDS.items() if values.get(name)}
+    if "query_count" in fields:
+        fields["query_count"] = round(fields["query_count"])
+    timings = get_timings(values, len(apubs))
+    if timings:
+        fields["timings"] = timings
+    if fields:
+        for apub in apubs:
+            for field, value in fields.items():
+                setattr(apub, field, value)
+            if timings:
+                logger.info(f"Deposit timings for article {apub.article_id}: {apub.timings_text()}")
+            check_query_budget(f"Deposit of article {apub.article_id}",
+                               apub.query_count,
+                               apub.query_time,
+                               getattr(settings, "ESCHOL_DEPOSIT_QUERY_BUDGET", None))
+        ArticlePublicationHistory.objects.filter(pk__in=[apub.pk for apub in apubs])\
+                                         .update(**fields)
+
+def check_query_budget(name, queries, query_time, budget):
+    """Logs the queries something ran, with a warning if there were more than budget"""
+    if not queries:
+        return
+    msg = f"{name} ran {queries} queries in {query_time or 0:.3f}s"
+    if budget and queries > budget:
+        logger.warning(f"{msg}, over the budget of {budget}")
     else:
+        logger.info(msg)
+
+def get_issue_timings(ipub):
+    """Adds up the stage timings of every article in an issue publication"""
+    apubs = ipub.articlepublicationhistory_set.filter(timings__isnull=False)\
+                                              .values_list("article_id", "timings")
+    stages = {}
+    slowest = None
+    for article_id, timings in apubs:
+        for stage, seconds in timings.items():
+            if stage != "total":
+                stages[stage] = stages.get(stage, 0) + seconds
+        if not slowest or timings["total"] > slowest["total"]:
+            slowest = {"article": article_id, "total": timings["total"]}
+    if not slowest:
+        return None
+    return {"articles": len(apubs),
+            "total": round(sum(stages.values()), 4),
+            "stages": {stage: round(seconds, 4) for stage, seconds in stages.items()},
+            "slowest": slowest}
+
+def record_issue_timings(ipub):
+    ipub.timings = get_issue_timings(ipub)
+    if ipub.timings:
+        logger.info(f"Deposit timings for {ipub.issue}: {ipub.timings_text()}")
+
+def send_article(article, configured=False, request=None, force=False, ordering=None):
+    with metrics.collecting() as values, metrics.counting_queries():
+        with metrics.timer("other"):
+            apub = deposit_article(article, configured, request, force, ordering)
+    record_metrics([apub], values)
+    return apub
+
+def deposit_article(article, configured=False, request=None, force=False, ordering=None):
+    error = check_article(article)
+    if error:
+        return article_error(article, request, error)
+
+    ordering = get_article_ordering(article, ordering)
+    # taken before depositing since registering the DOI can change the article
+    state_digest = get_state_digest(article, ordering)
+    try:
+        item = get_deposit_item(article, ordering=ordering)
+    except retry.EscholAPIError as e:
+        # the ark couldn't be minted
+        msg = f'ERROR sending Article {article.pk} to eScholarship: {e}'
+        return article_error(article, request, msg)
+
+    if not configured:
+        variables = {"item": item}
         logger.debug(f'Escholarhip Deposit for Article {article.pk}: {variables}')
         msg = f"eScholarship API not configured: {article} not sent"
         return article_error(article, request, msg)
 
-    return ArticlePublicationHistory.objects.create(article=article, success=True,)
+    return deposit_item(article, item, request, force, state_digest)
+
+def get_batch_deposit_query(aliases):
+    params = ", ".join([f"${a}: DepositItemInput!" for a in aliases])
+    fields = "".join([f"""    {a}: depositItem(input: ${a}) {{
+        id
+        message
+    }}
+""" for a in aliases])
+    return f"mutation depositItems({params}) {{\n{fields}}}\n"
+
+def get_batch_errors(data):
+    """Maps the alias in each GraphQL error path to its messages"""
+    errors = {}
+    for e in data.get("errors", []) or []:
+        path = e.get("path") or [None]
+        errors.setdefault(path[0], []).append(e.get("message", str(e)))
+    return errors
+
+def send_article_batch(articles, configured=False, request=None, force=False, ordering=None):
+    """Deposits several articles in one request using aliased depositItem mutations.
+
+    Returns ArticlePublicationHistory objects in article order.  If the
+    batch request itself fails each article is sent on its own instead.
+    """
+    if not configured or len(articles) < 2:
+        return [send_article(a, configured, request, force, ordering=ordering) for a in articles]
+
+    with metrics.collecting() as values, metrics.counting_queries():
+        with metrics.timer("other"):
+            apubs = deposit_article_batch(articles, request, force, ordering)
+    record_metrics(apubs, values)
+    return apubs
+
+def deposit_article_batch(articles, request=None, force=False, ordering=None):
+    apubs = {}
+    items = []
+    digests = {}
+    state_digests = {}
+    for a in articles:
+        error = check_article(a)
+        if error:
+            apubs[a.pk] = article_error(a, request, error)
+            continue
+        a_ordering = get_article_ordering(a, ordering)
+        state_digests[a.pk] = get_state_digest(a, a_ordering)
+        try:
+            item = get_deposit_item(a, ordering=a_ordering)
+        except retry.EscholAPIError as e:
+            msg = f'ERROR sending Article {a.pk} to eScholarship: {e}'
+            apubs[a.pk] = article_error(a, request, msg)
+            continue
+        digests[a.pk] = get_payload_digest(item)
+        if not force and is_unchanged(a, digests[a.pk]):
+            apubs[a.pk] = unchanged_article(a, request, digests[a.pk], state_digests[a.pk])
+        else:
+            items.append((f"item{len(items)}", a, item))
+
+    data = None
+    if items:
+        query = get_batch_deposit_query([alias for alias, _, _ in items])
+        variables = {alias: item for alias, _, item in items}
+        try:
+            with metrics.timer("deposit"):
+                r = send_to_eschol(query, variables, count=len(items))
+            data = json.loads(r.text)
+        except retry.RetryDeferred:
+            raise
+        except Exception as e: #pylint: disable=broad-exception-caught
+            logger.error(e, exc_info=True)
+
+        if not isinstance(data, dict) or not data.get("data"):
+            logger.warning(f"Batch deposit of {len(items)} articles failed, sending individually")
+            # unchanged articles have already been filtered out
+            for _, a, item in items:
+                apubs[a.pk] = deposit_item(a,
+                                           item,
+                                           request,
+                                           force=True,
+                                           state_digest=state_digests[a.pk])
+            items = []
+
+    errors = get_batch_errors(data) if items else {}
+    for alias, a, item in items:
+        di = data["data"].get(alias)
+        if di:
+            try:
+                apubs[a.pk] = deposit_success(a,
+                                              di,
+                                              request,
+                                              digests[a.pk],
+                                              state_digests[a.pk])
+            except Exception as e: #pylint: disable=broad-exception-caught
+                msg = f'An unexpected error occured when sending {a} to eScholarship: {e}'
+                apubs[a.pk] = article_error(a, request, msg)
+        else:
+            error = errors.get(alias, errors.get(None))
+            msg = f'ERROR sending Article {a.pk} to eScholarship: {error}'
+            apubs[a.pk] = article_error(a, request, msg)
+
+    return [apubs[a.pk] for a in articles]
+
+def get_issue_meta_variables(issue):
+    unit = get_unit(issue.journal)
+
+    # media are hosted at ://domain/media not ://domain/site_code/media
+    # this is the most consistent way I can find to generate this url
+    j = issue.journal
+    cover_url = utils_logic.build_url(netloc=j.press.domain,
+                                      scheme=j.press.SCHEMES[j.press.is_secure],
+                                      port=None,
+                                      path=issue.cover_image.url)
+    return {"input": {"journal": unit,
+                      "issue": int(issue.issue),
+                      "volume": issue.volume,
+                      "coverImageURL": cover_url}}
+
+def get_issue_meta_digest(issue):
+    if not (issue.cover_image and issue.cover_image.url):
+        return None
+    try:
+        return get_payload_digest(get_issue_meta_variables(issue))
+    except ValueError:
+        return None
 
-def send_issue_meta(issue, configured=False):
+def is_issue_meta_unchanged(issue, digest):
+    last = IssuePublicationHistory.objects.filter(issue=issue)\
+                                          .exclude(meta_digest=None)\
+                                          .first()
+    return last is not None and last.meta_digest == digest
+
+def send_issue_meta(issue, configured=False, force=False):
     success = False
     msg = None
     if issue.cover_image and issue.cover_image.url:
-        unit = get_unit(issue.journal)
-
-        # media are hosted at ://domain/media not ://domain/site_code/media
-        # this is the most consistent way I can find to generate this url
-        j = issue.journal
-        cover_url = utils_logic.build_url(netloc=j.press.domain,
-                                          scheme=j.press.SCHEMES[j.press.is_secure],
-                                          port=None,
-                                          path=issue.cover_image.url)
         try:
-            variables = {"input": {"journal": unit,
-                                   "issue": int(issue.issue),
-                                   "volume": issue.volume,
-                                   "coverImageURL": cover_url}}
+            variables = get_issue_meta_variables(issue)
         except ValueError:
             success = False
             msg = f"Cannot upload cover images for non-integer issue number {issue.issue}"
@@ -551,6 +1356,10 @@ def send_issue_meta(issue, configured=False):
 
 
         if configured:
+            if not force and is_issue_meta_unchanged(issue, get_payload_digest(variables)):
+                logger.info(f"Cover image for {issue} unchanged, not sent")
+                return True, UNCHANGED
+
             r = send_to_eschol(ISSUE_QUERY, variables)
             d = json.loads(r.text)
             if "errors" in d:
@@ -572,6 +1381,12 @@ def send_issue_meta(issue, configured=False):
 
     return success, msg
 
+def record_issue_meta(ipub, success, msg, configured):
+    ipub.success = success
+    ipub.result = msg
+    if success and configured:
+        ipub.meta_digest = get_issue_meta_digest(ipub.issue)
+
 def is_configured():
     if hasattr(settings, 'ESCHOL_API_URL'):
         return True
@@ -579,25 +1394,142 @@ def is_configured():
     logger.info("Escholarship API not configured.")
     return False
 
+def get_issue_workers(options):
+    workers = options.get("workers")
+    if not workers:
+        workers = getattr(settings, "ESCHOL_ISSUE_WORKERS", 1)
+    return max(int(workers), 1)
+
+def get_deposit_batch_size(options):
+    batch_size = options.get("batch_size")
+    if not batch_size:
+        batch_size = getattr(settings, "ESCHOL_DEPOSIT_BATCH_SIZE", 1)
+    return max(int(batch_size), 1)
+
+def send_article_batch_in_thread(articles, configured, request, force, ordering=None,
+                                 deferring=False):
+    try:
+        # retry.deferring is thread local, carry it over from the caller's thread
+        with retry.deferring(deferring):
+            return send_article_batch(articles, configured, request, force, ordering=ordering)
+    finally:
+        # each thread gets its own db connection, don't leave them open
+        connections.close_all()
+
+def send_articles(articles, configured=False, request=None, workers=1, batch_size=1, force=False,
+                  ordering=None):
+    """Sends each article, yielding ArticlePublicationHistory objects in article order.
+
+    Articles are deposited in batches of `batch_size`.  With more than one
+    worker the batches are deposited in parallel using a thread pool of
+    that size.  If a batch is deferred the batches that were sent are
+    yielded before RetryDeferred is raised.
+    """
+    batches = [articles[i:i + batch_size] for i in range(0, len(articles), batch_size)]
+    if workers <= 1 or len(batches) <= 1:
+        for batch in batches:
+            yield from send_article_batch(batch, configured, request, force, ordering=ordering)
+        return
+
+    deferred = None
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="eschol") as executor:
+        futures = [executor.submit(send_article_batch_in_thread,
+                                   batch,
+                                   configured,
+                                   request,
+                                   force,
+                                   ordering,
+                                   retry.is_deferring())
+                   for batch in batches]
+        for future in futures:
+            if future.cancelled():
+                continue
+            try:
+                apubs = future.result()
+            except retry.RetryDeferred as e:
+                # don't start more batches, but still yield the ones other
+                # threads finished so they're recorded on the publication
+                deferred = deferred or e
+                for f in futures:
+                    f.cancel()
+                continue
+            yield from apubs
+    if deferred:
+        raise deferred
+
+def checkpoint_issue_publication(ipub):
+    """Saves the progress of an issue publication so a retry can pick up where it stopped"""
+    ipub.last_checkpoint = timezone.now()
+    ipub.save()
+
+def resume_issue_publication(ipub):
+    """Reuses an incomplete IssuePublicationHistory for another attempt"""
+    ipub.attempts += 1
+    checkpoint_issue_publication(ipub)
+    done, total = ipub.progress()
+    logger.info(f"Resuming {ipub.issue} publication {ipub.pk} (attempt {ipub.attempts}): "
+                f"{done} of {total} articles already sent")
+    return ipub
+
+def get_unsent_articles(ipub, articles):
+    """Filters out articles that already have a result in this issue publication"""
+    sent = set(ipub.articlepublicationhistory_set.values_list("article_id", flat=True))
+    return [a for a in articles if a.pk not in sent]
+
 def issue_to_eschol(**options):
     request = options.get("request")
     issue = options.get("issue")
+    force = options.get("force", False)
+    incremental = options.get("incremental", False)
+    # an incomplete publication to resume
+    ipub = options.get("ipub")
     configured = is_configured()
 
     try:
-        ipub = IssuePublicationHistory.objects.create(issue=issue, success=False)
-
-        success, msg = send_issue_meta(issue, configured)
-
-        ipub.success = success
-        ipub.result = msg
-        ipub.save()
-
-        for a in issue.get_sorted_articles():
-            apub = send_article(a, configured, request)
+        if ipub is None:
+            ipub = IssuePublicationHistory.objects.create(issue=issue, success=False)
+
+        # load everything the deposit payloads need in a fixed number of queries
+        articles = get_issue_articles(issue)
+        ordering = get_issue_ordering(issue)
+
+        # total_articles is saved with the metadata result, if it's set the
+        # metadata was sent by an earlier attempt
+        if ipub.total_articles is None:
+            success, msg = send_issue_meta(issue, configured, force=force)
+            record_issue_meta(ipub, success, msg, configured)
+            ipub.total_articles = len(articles)
+        checkpoint_issue_publication(ipub)
+
+        articles = get_unsent_articles(ipub, articles)
+
+        if incremental:
+            articles, not_modified = split_modified_articles(articles, ordering)
+            for a, state_digest in not_modified:
+                not_modified_article(a, request, state_digest, issue_pub=ipub)
+
+        if configured and premint_arks(articles):
+            # reload so the prefetched EscholArticles include the new arks
+            pks = {a.pk for a in articles}
+            articles = [a for a in get_issue_articles(issue) if a.pk in pks]
+
+        workers = get_issue_workers(options)
+        batch_size = get_deposit_batch_size(options)
+        for apub in send_articles(articles,
+                                  configured,
+                                  request,
+                                  workers=workers,
+                                  batch_size=batch_size,
+                                  force=force,
+                                  ordering=ordering):
             ipub.success = ipub.success and apub.success
             apub.issue_pub = ipub
             apub.save()
+            checkpoint_issue_publication(ipub)
+    except retry.RetryDeferred:
+        # leave the publication incomplete, the task resumes it later
+        ipub.save()
+        raise
     except Exception as e: #pylint: disable=broad-exception-caught
         msg = f'An unexpected error occured when sending {issue} to eScholarship: {e}'
         logger.error(e, exc_info=True)
@@ -606,13 +1538,94 @@ def issue_to_eschol(**options):
         ipub.result = msg
 
     ipub.is_complete = True
+    record_issue_timings(ipub)
     ipub.save()
+    logger.info(f"eScholarship API connections after {issue}: {client.pool_stats()}")
+
+    return ipub
 
+def start_issue_publication(issue, total_articles, configured=False, force=False, ipub=None):
+    """Creates the IssuePublicationHistory for a queued issue publication, unless
+    one is being resumed, and sends the issue metadata.  Articles are sent by
+    separate tasks."""
+    if ipub is None:
+        ipub = IssuePublicationHistory.objects.create(issue=issue, success=False)
+    try:
+        success, msg = send_issue_meta(issue, configured, force=force)
+    except retry.RetryDeferred:
+        raise
+    except Exception as e: #pylint: disable=broad-exception-caught
+        logger.error(e, exc_info=True)
+        success = False
+        msg = f'An unexpected error occured when sending {issue} to eScholarship: {e}'
+    record_issue_meta(ipub, success, msg, configured)
+    ipub.total_articles = total_articles
+    checkpoint_issue_publication(ipub)
+    return ipub
+
+def publish_issue_article(ipub_id, article_id, force=False, order=None):
+    """Deposits one article of a queued issue publication.
+
+    `order` is the article's entry in the issue ordering, built once when
+    the articles were queued.
+    """
+    ipub = IssuePublicationHistory.objects.get(pk=ipub_id)
+    # the article may have been queued again when the publication was resumed
+    apub = ipub.articlepublicationhistory_set.filter(article_id=article_id).first()
+    if apub:
+        return apub
+    article = prefetch_articles(Article.objects.filter(pk=article_id)).get()
+    ordering = {"issue": ipub.issue_id, "articles": {article_id: tuple(order)}} if order else None
+    apub = send_article(article, is_configured(), force=force, ordering=ordering)
+    apub.issue_pub = ipub
+    apub.save()
+    IssuePublicationHistory.objects.filter(pk=ipub_id).update(last_checkpoint=timezone.now())
+    return apub
+
+def record_issue_article_failure(ipub_id, article_id, msg):
+    """Records a failed article for a queued task that died before recording its own result"""
+    apubs = ArticlePublicationHistory.objects.filter(issue_pub_id=ipub_id, article_id=article_id)
+    if apubs.exists():
+        return apubs.first()
+    logger.error(msg)
+    return ArticlePublicationHistory.objects.create(article_id=article_id,
+                                                    issue_pub_id=ipub_id,
+                                                    success=False,
+                                                    result=msg)
+
+def finalize_issue_publication(ipub_id):
+    """Marks a queued issue publication complete once every article has a result.
+
+    The issue is successful if the metadata was sent and every article succeeded.
+    """
+    with transaction.atomic():
+        ipub = IssuePublicationHistory.objects.select_for_update().get(pk=ipub_id)
+        if ipub.is_complete:
+            return ipub
+
+        apubs = ipub.articlepublicationhistory_set.all()
+        done, total = ipub.progress()
+        if total and done < total:
+            return ipub
+
+        failed = apubs.filter(success=False)
+        ipub.success = ipub.success and not failed.exists()
+        results = [ipub.result] if ipub.result else []
+        results.extend([f"{apub.article}: {apub.result}" for apub in failed])
+        ipub.result = "\n".join(results)
+        ipub.is_complete = True
+        record_issue_timings(ipub)
+        ipub.save()
+    logger.info(f"eScholarship publication complete: {ipub}")
     return ipub
 
 def article_to_eschol(**options):
     request = options.get('request')
     article = options.get("article")
+    force = options.get("force", False)
     configured = is_configured()
 
-    return send_article(article, configured, request)
+    # from the publish article view or the article published event, don't
+    # keep the editor waiting on a long retry
+    with retry.interactive(request is not None):
+        return send_article(article, configured, request, force)
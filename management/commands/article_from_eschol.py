@@ -1,7 +1,9 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
-import requests, pprint, json
+import pprint, json
+
+from plugins.eschol import client
 
 class Command(BaseCommand):
     """Retrieves and prints a given article from escholarship via graphql api"""
@@ -64,7 +66,7 @@ class Command(BaseCommand):
         url = settings.ESCHOL_API_URL
         #params = {'access': settings.ESCHOL_ACCESS_TOKEN}
         #headers = {"Privileged": settings.ESCHOL_PRIV_KEY}
-        r = requests.post(url, json={'query': query, 'variables': variables})
+        r = client.post(url, json={'query': query, 'variables': variables})
 
         json_data = json.loads(r.text)
 
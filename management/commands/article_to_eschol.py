@@ -12,12 +12,16 @@ class Command(BaseCommand):
         parser.add_argument(
             "article_id", help="`id` of article to send to escholarship", type=int
         )
+        parser.add_argument(
+            "--force", help="deposit even if nothing has changed since the last deposit",
+            action="store_true"
+        )
 
     def handle(self, *args, **options):
         article_id = options.get("article_id")
         article = Article.objects.get(id=article_id)
 
-        apub = logic.article_to_eschol(article=article)
+        apub = logic.article_to_eschol(article=article, force=options.get("force"))
         if apub.success:
             print(f'Deposited article {article.pk} to eScholarship at {epub.ark}')
             epub = EscholArticle.objects.get(article=article)
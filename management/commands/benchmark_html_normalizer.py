@@ -0,0 +1,61 @@
+from timeit import default_timer
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Galley
+from journal.models import Issue
+from plugins.eschol import logic
+
+class Command(BaseCommand):
+    """Compares the HTML normalizer backends on a set of JATS galleys"""
+    help = "Times the lxml and xmllint HTML normalizers on rendered XML galleys or HTML files"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--galley", help="`id` of an XML galley to render", type=int, nargs="*", default=[]
+        )
+        parser.add_argument(
+            "--issue", help="`id` of an issue whose XML render galleys should be used", type=int
+        )
+        parser.add_argument(
+            "--file", help="path to an already rendered HTML file", type=str, nargs="*", default=[]
+        )
+        parser.add_argument(
+            "--repeat", help="number of times to normalize each document", type=int, default=5
+        )
+
+    def handle(self, *args, **options):
+        galleys = list(Galley.objects.filter(pk__in=options.get("galley")))
+        if options.get("issue"):
+            for a in Issue.objects.get(pk=options.get("issue")).get_sorted_articles():
+                rg = a.get_render_galley
+                if rg and rg.file and rg.file.mime_type in logic.XML_MIMETYPES:
+                    galleys.append(rg)
+
+        docs = []
+        for g in galleys:
+            docs.append((f"galley {g.pk}", logic.render_galley_html(g.article, g)))
+        for path in options.get("file"):
+            with open(path, "rb") as f:
+                docs.append((path, f.read()))
+
+        if not docs:
+            raise CommandError("No documents to normalize, use --galley, --issue or --file")
+
+        repeat = max(options.get("repeat"), 1)
+        totals = {backend: 0.0 for backend in logic.HTML_NORMALIZERS}
+        for name, doc in docs:
+            outputs = {}
+            for backend in logic.HTML_NORMALIZERS:
+                start = default_timer()
+                for _ in range(repeat):
+                    outputs[backend] = logic.normalize_html(doc, backend=backend)
+                elapsed = (default_timer() - start) / repeat
+                totals[backend] += elapsed
+                print(f"{name}\t{backend}\t{elapsed * 1000:.2f} ms")
+            if len(set(outputs.values())) > 1:
+                print(f"{name}\tWARNING: normalizer output differs")
+
+        for backend, total in totals.items():
+            print(f"{backend}: {total * 1000:.2f} ms for {len(docs)} documents "
+                  f"({total / len(docs) * 1000:.2f} ms per document)")
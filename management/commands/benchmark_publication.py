@@ -0,0 +1,172 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from plugins.eschol import benchmark, stub_server
+
+def sum_or_none(values):
+    values = list(values)
+    return None if None in values else sum(values)
+
+class Command(BaseCommand):
+    """Times issue publication on synthetic journals against a stub eScholarship API"""
+    help = "Builds synthetic issues, publishes them to a stub eScholarship API " \
+           "and reports throughput, queries, memory and time per stage as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", help="number of articles in each issue", type=int, nargs="*",
+            default=[10, 100, 1000]
+        )
+        parser.add_argument(
+            "--authors", help="authors per article", type=int, default=20
+        )
+        parser.add_argument(
+            "--supp-files", help="supplementary files per article", type=int, default=1
+        )
+        parser.add_argument(
+            "--images", help="images per local galley", type=int, default=1
+        )
+        parser.add_argument(
+            "--xml-file", help="JATS file to use for XML galleys instead of generated JATS",
+            type=str
+        )
+        parser.add_argument(
+            "--repeat", help="number of times to publish each issue", type=int, default=1
+        )
+        parser.add_argument(
+            "--workers", help="number of articles to deposit in parallel", type=int, default=1
+        )
+        parser.add_argument(
+            "--batch-size", help="number of articles to deposit per API request", type=int,
+            default=1
+        )
+        parser.add_argument(
+            "--latency", help="latency of the built in stub API, e.g. 0.05 or lognormal:-3,0.5",
+            type=str
+        )
+        parser.add_argument(
+            "--seed", help="random seed of the built in stub API", type=int, default=1
+        )
+        parser.add_argument(
+            "--api-url", help="use an already running stub API (see eschol_stub_server) "
+                              "instead of the built in one", type=str
+        )
+        parser.add_argument(
+            "--output", help="file to write the results to as JSON", type=str
+        )
+        parser.add_argument(
+            "--compare", help="JSON results of an earlier run to compare with", type=str
+        )
+        parser.add_argument(
+            "--keep", help="don't delete the synthetic journal afterwards", action="store_true"
+        )
+
+    def handle(self, *args, **options):
+        sizes = options.get("sizes")
+        if not sizes or min(sizes) < 1:
+            raise CommandError("Issue sizes must be at least 1")
+        previous = None
+        if options.get("compare"):
+            with open(options.get("compare"), encoding="utf-8") as f:
+                previous = json.load(f)
+
+        if options.get("workers") > 1:
+            print("Warning: queries are only counted on the main thread, "
+                  "they aren't reported with more than one worker")
+
+        print(f"Building a journal with issues of {', '.join(map(str, sizes))} articles")
+        journal, issues = benchmark.build_journal(sizes,
+                                                  authors=options.get("authors"),
+                                                  supp_files=options.get("supp_files"),
+                                                  images=options.get("images"),
+                                                  xml_file=options.get("xml_file"))
+        server = None
+        results = {"settings": {k: options.get(k) for k in ["sizes", "authors", "supp_files",
+                                                              "images", "xml_file", "workers",
+                                                              "batch_size", "latency", "api_url"]},
+                   "issues": [],
+                   "journal": []}
+        try:
+            url = options.get("api_url")
+            if not url:
+                latency = options.get("latency")
+                api = stub_server.StubAPI(latency={"default": latency} if latency else None,
+                                          fetch_links=False,
+                                          seed=options.get("seed"))
+                server = stub_server.start(api)
+                url = server.url
+
+            with override_settings(ESCHOL_API_URL=url,
+                                   ESCHOL_ACCESS_TOKEN="benchmark",
+                                   ESCHOL_PRIV_KEY="benchmark",
+                                   JSCHOL_URL=getattr(settings, "JSCHOL_URL",
+                                                      "https://escholarship.org/")):
+                for run in range(1, max(options.get("repeat"), 1) + 1):
+                    run_results = []
+                    for size, issue in zip(sizes, issues):
+                        r = benchmark.publish_issue(issue,
+                                                    workers=options.get("workers"),
+                                                    batch_size=options.get("batch_size"))
+                        r.update({"size": size, "run": run})
+                        run_results.append(r)
+                        self.print_result(f"run {run} issue of {size}", r)
+                    results["issues"].extend(run_results)
+
+                    n = sum(r["articles"] for r in run_results)
+                    wall_time = sum(r["wall_time"] for r in run_results)
+                    totals = {"run": run,
+                              "articles": n,
+                              "wall_time": round(wall_time, 3),
+                              "articles_per_second": round(n / wall_time, 3) if wall_time else None,
+                              "queries": sum_or_none(r["queries"] for r in run_results),
+                              "peak_rss_growth_kb": max(r["peak_rss_growth_kb"]
+                                                        for r in run_results)}
+                    results["journal"].append(totals)
+                    print(f"run {run} journal: {n} articles in {totals['wall_time']}s "
+                          f"({totals['articles_per_second']} articles/s)")
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+            if options.get("keep"):
+                print(f"Kept journal {journal.code}")
+            else:
+                benchmark.delete_journal(journal)
+
+        if options.get("output"):
+            with open(options.get("output"), "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {options.get('output')}")
+        if previous:
+            self.compare(previous, results)
+
+    def print_result(self, label, r):
+        stages = ", ".join([f"{k} {v:.3f}s" for k, v in
+                            sorted(r["stages"].items(), key=lambda s: s[1], reverse=True)])
+        queries = f", {r['queries']} queries ({r['query_time']}s)" \
+                  if r["queries"] is not None else ""
+        print(f"{label}: {r['successful']} of {r['articles']} articles in {r['wall_time']}s "
+              f"({r['articles_per_second']} articles/s){queries}, RSS grew "
+              f"{r['rss_growth_kb']} KB, peak RSS grew {r['peak_rss_growth_kb']} KB")
+        if stages:
+            print(f"\t{stages}")
+
+    def compare(self, previous, results):
+        workers = [previous.get("settings", {}).get("workers"), results["settings"]["workers"]]
+        queries = all(w is not None and w <= 1 for w in workers)
+        if not queries:
+            print("Warning: not comparing queries, they are only counted with one worker")
+        before = {(r["size"], r["run"]): r for r in previous.get("issues", [])}
+        for r in results["issues"]:
+            old = before.get((r["size"], r["run"]))
+            if not old or not old["articles_per_second"] or not r["articles_per_second"]:
+                continue
+            change = (r["articles_per_second"] / old["articles_per_second"] - 1) * 100
+            msg = f"run {r['run']} issue of {r['size']}: {old['articles_per_second']} -> " \
+                  f"{r['articles_per_second']} articles/s ({change:+.1f}%)"
+            if queries:
+                msg += f", queries {old['queries']} -> {r['queries']}"
+            print(msg)
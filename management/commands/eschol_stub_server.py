@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from plugins.eschol import stub_server
+
+class Command(BaseCommand):
+    """Runs a local stand-in for the eScholarship GraphQL API"""
+    help = "Runs a local stub of the eScholarship GraphQL API for load and failure testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--host", help="address to listen on", type=str, default="127.0.0.1"
+        )
+        parser.add_argument(
+            "--port", help="port to listen on", type=int, default=8765
+        )
+        parser.add_argument(
+            "--latency", help="latency of every field in seconds, e.g. 0.05, uniform:0.01,0.2, "
+                              "normal:0.1,0.02, lognormal:-2.3,0.5 or exponential:0.1", type=str
+        )
+        parser.add_argument(
+            "--deposit-latency", help="latency of depositItem, overrides --latency", type=str
+        )
+        parser.add_argument(
+            "--mint-latency", help="latency of mintProvisionalID, overrides --latency", type=str
+        )
+        parser.add_argument(
+            "--issue-latency", help="latency of updateIssue, overrides --latency", type=str
+        )
+        parser.add_argument(
+            "--deadlock-rate", help="fraction of requests answered with a deadlock error",
+            type=float, default=0
+        )
+        parser.add_argument(
+            "--error-rate", help="fraction of requests answered with HTTP 503",
+            type=float, default=0
+        )
+        parser.add_argument(
+            "--timeout-rate", help="fraction of requests that hang for --timeout seconds",
+            type=float, default=0
+        )
+        parser.add_argument(
+            "--timeout", help="seconds a timed out request hangs", type=float, default=60
+        )
+        parser.add_argument(
+            "--max-rps", help="requests answered per second, the rest wait their turn",
+            type=float
+        )
+        parser.add_argument(
+            "--reject-over-cap", help="answer requests over --max-rps with HTTP 429",
+            action="store_true"
+        )
+        parser.add_argument(
+            "--no-fetch", help="don't fetch contentLink/fetchLink files", action="store_true"
+        )
+        parser.add_argument(
+            "--seed", help="random seed for repeatable runs", type=int
+        )
+        parser.add_argument(
+            "--verbose", help="log every request", action="store_true"
+        )
+
+    def handle(self, *args, **options):
+        latency = {"default": options.get("latency"),
+                   "depositItem": options.get("deposit_latency"),
+                   "mintProvisionalID": options.get("mint_latency"),
+                   "updateIssue": options.get("issue_latency")}
+        try:
+            api = stub_server.StubAPI(latency={k: v for k, v in latency.items() if v},
+                                      deadlock_rate=options.get("deadlock_rate"),
+                                      error_rate=options.get("error_rate"),
+                                      timeout_rate=options.get("timeout_rate"),
+                                      timeout=options.get("timeout"),
+                                      max_rps=options.get("max_rps"),
+                                      reject_over_cap=options.get("reject_over_cap"),
+                                      fetch_links=not options.get("no_fetch"),
+                                      seed=options.get("seed"))
+        except ValueError as e:
+            raise CommandError(e) from e
+
+        server = stub_server.StubServer((options.get("host"), options.get("port")),
+                                        api,
+                                        verbose=options.get("verbose"))
+        print(f"Stub eScholarship API at {server.url}, set ESCHOL_API_URL to use it")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        for name, value in sorted(api.stats().items()):
+            print(f"{name}: {value}")
@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 
 from journal.models import Issue
-from plugins.eschol import logic
+from plugins.eschol import logic, client
 from plugins.eschol.models import EscholArticle
 
 class Command(BaseCommand):
@@ -12,12 +12,30 @@ class Command(BaseCommand):
         parser.add_argument(
             "issue_id", help="`id` of issue to send to escholarship", type=int
         )
+        parser.add_argument(
+            "--force", help="deposit even if nothing has changed since the last deposit",
+            action="store_true"
+        )
+        parser.add_argument(
+            "--incremental", help="only deposit articles changed since their last deposit",
+            action="store_true"
+        )
+        parser.add_argument(
+            "--workers", help="number of articles to deposit in parallel", type=int
+        )
+        parser.add_argument(
+            "--batch-size", help="number of articles to deposit per API request", type=int
+        )
 
     def handle(self, *args, **options):
         issue_id = options.get("issue_id")
         issue = Issue.objects.get(id=issue_id)
 
-        ipub = logic.issue_to_eschol(issue=issue)
+        ipub = logic.issue_to_eschol(issue=issue,
+                                     workers=options.get("workers"),
+                                     batch_size=options.get("batch_size"),
+                                     force=options.get("force"),
+                                     incremental=options.get("incremental"))
         print(ipub)
         if not ipub.success:
             print(ipub.result)
@@ -26,7 +44,10 @@ class Command(BaseCommand):
             if not apub.success:
                 print(apub.result)
             epub = EscholArticle.objects.get(article=apub.article)
-            if epub.has_doi_error():
+            if epub.doi_pending:
+                print('\tDOI registration queued')
+            elif epub.has_doi_error():
                 print(f'\tDOI registered {apub.article.get_doi()}')
             else:
-                print(f'\tDOI not registered: {epub.doi_result_text}')
\ No newline at end of file
+                print(f'\tDOI not registered: {epub.doi_result_text}')
+        print(f'eScholarship API connections: {client.pool_stats()}')
\ No newline at end of file
@@ -1,20 +1,52 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from submission.models import Article
+from submission.models import STAGE_PUBLISHED, Article
+from journal.models import Issue, Journal
 from plugins.eschol import logic
 
 class Command(BaseCommand):
-    """Mints a provisional id for an article (mostly for testing)"""
-    help = "Mints a provisional id for an article"
+    """Mints provisional ids for articles that need them"""
+    help = "Mints provisional ids for the given articles, or every article in an issue or journal"
 
     def add_arguments(self, parser):
         parser.add_argument(
-            "article_id", help="`id` of article that needs an id", type=int
+            "article_id", help="`id` of article that needs an id", type=int, nargs="*"
+        )
+        parser.add_argument(
+            "--issue", help="`id` of issue whose articles need ids", type=int
+        )
+        parser.add_argument(
+            "--journal", help="`code` of journal whose articles need ids", type=str
         )
 
     def handle(self, *args, **options):
-        article_id = options.get("article_id")
-        article = Article.objects.get(id=article_id)
-        ark = logic.get_provisional_id(article)
-        print(ark)
-        
\ No newline at end of file
+        article_ids = options.get("article_id")
+        issue_id = options.get("issue")
+        journal_code = options.get("journal")
+
+        if issue_id:
+            articles = list(Issue.objects.get(id=issue_id).get_sorted_articles())
+        elif journal_code:
+            if not Journal.objects.filter(code=journal_code).exists():
+                raise CommandError(f'Journal does not exist {journal_code}')
+            articles = list(Article.objects.filter(journal__code=journal_code,
+                                                   stage=STAGE_PUBLISHED))
+        elif article_ids:
+            articles = list(Article.objects.filter(id__in=article_ids))
+        else:
+            raise CommandError("Specify article ids, --issue or --journal")
+
+        if not logic.is_configured():
+            for article in articles:
+                print(f"{article.pk}\t{logic.get_provisional_id(article)}")
+            return
+
+        # articles given explicitly get an ark whatever their galley type
+        if article_ids and not issue_id and not journal_code:
+            epubs = logic.mint_provisional_ids(articles)
+        else:
+            epubs = logic.premint_arks(articles)
+
+        for epub in epubs:
+            print(f"{epub.article_id}\t{epub.ark}")
+        print(f"Minted {len(epubs)} provisional ids")
@@ -0,0 +1,174 @@
+import cProfile, io, os, pstats, tracemalloc
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from journal.models import Issue
+from submission.models import Article
+from plugins.eschol import logic, profiling, stub_server
+
+MODES = ("json", "dry-run", "stub")
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    """Profiles building or depositing one article or issue"""
+    help = "Runs an article or issue deposit under cProfile and reports the slowest " \
+           "functions, SQL queries and memory allocations. Database changes are rolled back " \
+           "and files written during the run are deleted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--article", help="`id` of the article to profile", type=int
+        )
+        parser.add_argument(
+            "--issue", help="`id` of the issue to profile", type=int
+        )
+        parser.add_argument(
+            "--mode", help="json: only build the deposit json with the API unconfigured, "
+                           "dry-run: deposit with the API "
+                           "unconfigured, stub: deposit to a local stub API (default dry-run)",
+            choices=MODES, default="dry-run"
+        )
+        parser.add_argument(
+            "--latency", help="latency of the stub API, e.g. 0.05 or lognormal:-3,0.5", type=str
+        )
+        parser.add_argument(
+            "--register-dois", help="register DOIs with EZID as a real deposit would",
+            action="store_true"
+        )
+        parser.add_argument(
+            "--sort", help="pstats sort key for the function listing", type=str,
+            default="cumulative"
+        )
+        parser.add_argument(
+            "--limit", help="number of functions, queries and allocations to list",
+            type=int, default=25
+        )
+        parser.add_argument(
+            "--tracemalloc", help="trace memory allocations", action="store_true"
+        )
+        parser.add_argument(
+            "--pstats", help="file to write the cProfile stats to", type=str
+        )
+        parser.add_argument(
+            "--folded", help="file to write sampled stacks to in folded (flamegraph) format",
+            type=str
+        )
+        parser.add_argument(
+            "--sample-interval", help="seconds between stack samples for --folded",
+            type=float, default=0.001
+        )
+
+    def get_run(self, options):
+        """Returns the function to profile and the articles it deposits"""
+        mode = options.get("mode")
+        if options.get("article"):
+            article = Article.objects.get(pk=options.get("article"))
+            if mode == "json":
+                return lambda: logic.get_article_json(article, logic.get_unit(article.journal)), \
+                       [article]
+            return lambda: logic.send_article(article, configured=mode == "stub", force=True), \
+                   [article]
+        if options.get("issue"):
+            issue = Issue.objects.get(pk=options.get("issue"))
+            articles = list(issue.get_sorted_articles())
+            if mode == "json":
+                return lambda: logic.get_issue_article_json(issue), articles
+            # a single thread so every article is profiled
+            return lambda: logic.issue_to_eschol(issue=issue, force=True, workers=1), articles
+        raise CommandError("Use --article or --issue")
+
+    def get_settings(self, options, server):
+        overrides = {"ESCHOL_REGISTER_DOIS": options.get("register_dois")}
+        if server:
+            overrides.update({"ESCHOL_API_URL": server.url,
+                              "ESCHOL_ACCESS_TOKEN": "profile",
+                              "ESCHOL_PRIV_KEY": "profile",
+                              "JSCHOL_URL": getattr(settings, "JSCHOL_URL",
+                                                    "https://escholarship.org/")})
+        return overrides
+
+    def handle(self, *args, **options):
+        run, articles = self.get_run(options)
+        limit = options.get("limit")
+        # generated HTML is written next to the article's other files
+        folders = [os.path.join(settings.BASE_DIR, 'files', 'articles', str(a.pk))
+                   for a in articles]
+
+        server = None
+        if options.get("mode") == "stub":
+            latency = options.get("latency")
+            server = stub_server.start(stub_server.StubAPI(
+                latency={"default": latency} if latency else None,
+                fetch_links=False))
+
+        profiler = cProfile.Profile()
+        sampler = profiling.StackSampler(interval=options.get("sample_interval")) \
+                  if options.get("folded") else None
+        result = snapshot = peak = elapsed = None
+        try:
+            with override_settings(**self.get_settings(options, server)), \
+                 profiling.removing_new_files(folders):
+                # only the stub API is ever called, json mode would otherwise mint real arks
+                if not server and hasattr(settings, "ESCHOL_API_URL"):
+                    del settings.ESCHOL_API_URL
+                try:
+                    with transaction.atomic():
+                        with profiling.record_queries() as queries:
+                            if options.get("tracemalloc"):
+                                tracemalloc.start(25)
+                            if sampler:
+                                sampler.start()
+                            start = default_timer()
+                            profiler.enable()
+                            try:
+                                result = run()
+                            finally:
+                                profiler.disable()
+                                elapsed = default_timer() - start
+                                if sampler:
+                                    sampler.stop()
+                                if options.get("tracemalloc"):
+                                    snapshot = tracemalloc.take_snapshot()
+                                    _, peak = tracemalloc.get_traced_memory()
+                                    tracemalloc.stop()
+                        # leave the database as it was
+                        raise Rollback
+                except Rollback:
+                    pass
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+
+        if options.get("mode") != "json":
+            print(f"Result: {result}")
+        print(f"Wall time: {elapsed:.3f}s")
+
+        print(f"\nTop {limit} functions by {options.get('sort')}:")
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(options.get("sort")).print_stats(limit)
+        print(out.getvalue())
+
+        print(f"{len(queries)} SQL queries in {sum(q['time'] for q in queries):.3f}s, "
+              f"slowest first:")
+        for g in profiling.summarize_queries(queries)[:limit]:
+            sql = g["sql"] if len(g["sql"]) < 200 else g["sql"][:200] + "..."
+            print(f"{g['time'] * 1000:9.2f} ms  {g['count']:4d}x  {g['location']}\n\t{sql}")
+
+        if snapshot:
+            print(f"\nPeak traced memory: {peak / 1024:.1f} KB. Top {limit} allocations:")
+            for stat in snapshot.statistics("lineno")[:limit]:
+                print(f"\t{stat}")
+
+        if options.get("pstats"):
+            profiler.dump_stats(options.get("pstats"))
+            print(f"\ncProfile stats written to {options.get('pstats')}")
+        if sampler:
+            sampler.write_folded(options.get("folded"))
+            print(f"Folded stacks written to {options.get('folded')}")
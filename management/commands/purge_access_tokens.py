@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from plugins.eschol import logic
+
+class Command(BaseCommand):
+    """Deletes expired file access tokens"""
+    help = "Deletes expired file access tokens in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", help="number of tokens deleted per query", type=int
+        )
+
+    def handle(self, *args, **options):
+        deleted = logic.purge_expired_access_tokens(options.get("batch_size"))
+        print(f"Deleted {deleted} expired access tokens")
@@ -0,0 +1,92 @@
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.db import connection
+
+# Collects per deposit measurements (seconds spent waiting, stage timings, ...)
+# without threading a collector through every call.  Collectors are thread
+# local so articles deposited in parallel threads don't mix their numbers,
+# and nested collectors all see the values added while they are open.
+_local = threading.local()
+
+def get_stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+@contextmanager
+def collecting():
+    """Collects the values added in this thread until the block exits"""
+    values = {}
+    stack = get_stack()
+    stack.append(values)
+    try:
+        yield values
+    finally:
+        stack.pop()
+
+def add(name, value):
+    for values in get_stack():
+        values[name] = values.get(name, 0) + value
+
+def get_timers():
+    if not hasattr(_local, "timers"):
+        _local.timers = []
+    return _local.timers
+
+@contextmanager
+def timer(name):
+    """Adds the time spent in the block to `name`.
+
+    Time spent in timers nested inside the block is only added to the inner
+    timer's name, so the stages of a deposit add up to its total.
+    """
+    timers = get_timers()
+    nested = [0]
+    timers.append(nested)
+    start = default_timer()
+    try:
+        yield
+    finally:
+        elapsed = default_timer() - start
+        timers.pop()
+        if timers:
+            timers[-1][0] += elapsed
+        add(name, elapsed - nested[0])
+
+@contextmanager
+def timing_queries(callback):
+    """Calls callback(sql, seconds) after every query this thread's
+    connection runs in the block"""
+    def wrapper(execute, sql, params, many, context):
+        start = default_timer()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            callback(sql, default_timer() - start)
+
+    with connection.execute_wrapper(wrapper):
+        yield
+
+def add_query(_sql, elapsed):
+    add("queries", 1)
+    add("query_time", elapsed)
+
+@contextmanager
+def counting_queries():
+    """Adds the number of queries this thread runs in the block to "queries"
+    and the time they took to "query_time".
+
+    Nested blocks don't count queries twice.
+    """
+    if getattr(_local, "counting", False):
+        yield
+        return
+
+    _local.counting = True
+    try:
+        with timing_queries(add_query):
+            yield
+    finally:
+        _local.counting = False
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.20 on 2026-10-17 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0009_auto_20240823_2031'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issuepublicationhistory',
+            name='total_articles',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
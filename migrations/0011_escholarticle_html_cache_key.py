@@ -0,0 +1,18 @@
+# Generated by Django 3.2.20 on 2026-10-17 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0010_issuepublicationhistory_total_articles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='escholarticle',
+            name='html_cache_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.20 on 2026-10-17 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0011_escholarticle_html_cache_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articlepublicationhistory',
+            name='payload_digest',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='issuepublicationhistory',
+            name='meta_digest',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.20 on 2026-10-17 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0012_payload_digests'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='accesstoken',
+            index=models.Index(fields=['article_id', 'file_id', 'token'], name='eschol_accesstoken_lookup'),
+        ),
+        migrations.AddIndex(
+            model_name='accesstoken',
+            index=models.Index(fields=['date'], name='eschol_accesstoken_date'),
+        ),
+    ]
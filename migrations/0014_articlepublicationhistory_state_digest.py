@@ -0,0 +1,18 @@
+# Generated by Django 3.2.20 on 2026-10-17 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0013_accesstoken_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articlepublicationhistory',
+            name='state_digest',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.20 on 2026-10-17 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0014_articlepublicationhistory_state_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issuepublicationhistory',
+            name='attempts',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='issuepublicationhistory',
+            name='last_checkpoint',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.20 on 2026-10-17 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0015_issue_publication_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20, unique=True)),
+                ('tokens', models.FloatField(default=0)),
+                ('updated', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='articlepublicationhistory',
+            name='rate_limit_wait',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.20 on 2026-10-17 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0016_rate_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articlepublicationhistory',
+            name='retry_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='articlepublicationhistory',
+            name='retry_time',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.20 on 2026-10-17 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0017_retry_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CircuitBreaker',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=20, unique=True)),
+                ('state', models.CharField(choices=[('closed', 'Closed'), ('open', 'Open'), ('half_open', 'Half open')], default='closed', max_length=10)),
+                ('failures', models.IntegerField(default=0)),
+                ('opened', models.DateTimeField(blank=True, null=True)),
+                ('probe_started', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.20 on 2026-10-17 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0018_circuitbreaker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articlepublicationhistory',
+            name='timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='issuepublicationhistory',
+            name='timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
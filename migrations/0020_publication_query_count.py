@@ -0,0 +1,23 @@
+# Generated by Django 3.2.20 on 2026-10-17 18:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0019_publication_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articlepublicationhistory',
+            name='query_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='articlepublicationhistory',
+            name='query_time',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.20 on 2026-10-17 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eschol', '0020_publication_query_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='escholarticle',
+            name='doi_pending',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='escholarticle',
+            name='doi_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='escholarticle',
+            name='doi_next_attempt',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -6,6 +6,11 @@ from django.conf import settings
 from journal.models import Journal
 from submission.models import Article
 
+def format_stages(timings):
+    """Stages slowest first, e.g. "xslt 0.900s, deposit 0.300s" """
+    stages = sorted(timings.items(), key=lambda s: s[1], reverse=True)
+    return ", ".join([f"{stage} {seconds:.3f}s" for stage, seconds in stages])
+
 class JournalUnit(models.Model):
     journal = models.OneToOneField(Journal, null=True, on_delete=models.CASCADE)
     unit = models.CharField(max_length=50)
@@ -22,6 +27,11 @@ class EscholArticle(models.Model):
     doi_result_text = models.TextField(null=True, blank=True)
     source_name = models.CharField(max_length=20, null=True, blank=True)
     source_id = models.CharField(max_length=20, null=True, blank=True)
+    html_cache_key = models.CharField(max_length=64, null=True, blank=True)
+    # DOI registration queued for logic.register_pending_dois
+    doi_pending = models.BooleanField(default=False)
+    doi_attempts = models.IntegerField(default=0)
+    doi_next_attempt = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.article}: {self.ark}"
@@ -42,6 +52,13 @@ class AccessToken(models.Model):
     article_id = models.IntegerField()
     file_id = models.IntegerField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['article_id', 'file_id', 'token'],
+                         name='eschol_accesstoken_lookup'),
+            models.Index(fields=['date'], name='eschol_accesstoken_date'),
+        ]
+
     def generate_token(self):
         self.token = token_urlsafe(32)
         self.save()
@@ -55,6 +72,21 @@ class ArticlePublicationHistory(models.Model):
                                   on_delete=models.CASCADE)
     success = models.BooleanField()
     result = models.TextField(null=True, blank=True)
+    payload_digest = models.CharField(max_length=64, null=True, blank=True)
+    state_digest = models.CharField(max_length=64, null=True, blank=True)
+    rate_limit_wait = models.FloatField(null=True, blank=True)
+    retry_count = models.IntegerField(null=True, blank=True)
+    retry_time = models.FloatField(null=True, blank=True)
+    # seconds spent in each stage of the deposit and their "total"
+    timings = models.JSONField(null=True, blank=True)
+    query_count = models.IntegerField(null=True, blank=True)
+    query_time = models.FloatField(null=True, blank=True)
+
+    def timings_text(self):
+        if not self.timings:
+            return ""
+        stages = {k: v for k, v in self.timings.items() if k != "total"}
+        return f"{self.timings['total']:.3f}s ({format_stages(stages)})"
 
     def get_doi_error(self):
         e = EscholArticle.objects.filter(article=self.article)
@@ -80,6 +112,25 @@ class IssuePublicationHistory(models.Model):
     success = models.BooleanField(default=False)
     is_complete = models.BooleanField(default=False)
     result = models.TextField(null=True, blank=True)
+    total_articles = models.IntegerField(null=True, blank=True)
+    meta_digest = models.CharField(max_length=64, null=True, blank=True)
+    last_checkpoint = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=1)
+    # stage timings added up over the articles, see logic.get_issue_timings
+    timings = models.JSONField(null=True, blank=True)
+
+    def timings_text(self):
+        if not self.timings:
+            return ""
+        slowest = self.timings["slowest"]
+        return f"{self.timings['articles']} articles in {self.timings['total']:.3f}s " \
+               f"({format_stages(self.timings['stages'])}); " \
+               f"slowest article {slowest['article']} {slowest['total']:.3f}s"
+
+    def progress(self):
+        """Returns the number of articles with a result and the number expected"""
+        done = self.articlepublicationhistory_set.order_by().values("article_id").distinct().count()
+        return done, self.total_articles
 
     def result_text(self):
         if self.is_complete:
@@ -87,6 +138,9 @@ class IssuePublicationHistory(models.Model):
             total = self.articlepublicationhistory_set.all().count()
             return f"Successfully published {total_success} of {total} articles"
 
+        done, total = self.progress()
+        if total:
+            return f"Publication in process: {done} of {total} articles"
         return "Publication in process"
 
     def __str__(self):
@@ -101,3 +155,30 @@ class IssuePublicationHistory(models.Model):
 
     class Meta:
         ordering = ['-date']
+
+class RateLimitBucket(models.Model):
+    """Token bucket for eScholarship API calls shared by all workers"""
+    kind = models.CharField(max_length=20, unique=True)
+    tokens = models.FloatField(default=0)
+    updated = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.kind}: {self.tokens:.2f} tokens at {self.updated}"
+
+class CircuitBreaker(models.Model):
+    """State of the circuit breaker around the eScholarship API shared by all workers"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    STATE_CHOICES = ((CLOSED, "Closed"),
+                     (OPEN, "Open"),
+                     (HALF_OPEN, "Half open"))
+
+    name = models.CharField(max_length=20, unique=True)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=CLOSED)
+    failures = models.IntegerField(default=0)
+    opened = models.DateTimeField(blank=True, null=True)
+    probe_started = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.get_state_display()} ({self.failures} failures)"
@@ -0,0 +1,105 @@
+import os, sys, threading, time, traceback
+from contextlib import contextmanager
+
+from plugins.eschol import metrics
+
+# Tools for the profile_deposit command: a recorder for the SQL a deposit
+# runs and where it came from, cleanup of the files it writes, and a stack
+# sampler that writes the folded stacks flamegraph.pl, speedscope and inferno read.
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+# the query recording frames themselves
+SKIP_FILES = (os.path.abspath(__file__), os.path.abspath(metrics.__file__))
+
+def get_location(stack):
+    """The innermost plugin frame that issued a query, or the innermost
+    frame outside of django if the plugin isn't on the stack"""
+    outside = None
+    for frame in reversed(stack):
+        if os.path.abspath(frame.filename) in SKIP_FILES:
+            continue
+        if frame.filename.startswith(PLUGIN_DIR):
+            return f"{os.path.relpath(frame.filename, PLUGIN_DIR)}:{frame.lineno} in {frame.name}"
+        if outside is None and f"{os.sep}django{os.sep}" not in frame.filename:
+            outside = f"{frame.filename}:{frame.lineno} in {frame.name}"
+    return outside or "unknown"
+
+@contextmanager
+def record_queries():
+    """Records the SQL, duration and location of every query this thread runs"""
+    queries = []
+    def record(sql, elapsed):
+        queries.append({"sql": sql,
+                        "time": elapsed,
+                        "location": get_location(traceback.extract_stack())})
+    with metrics.timing_queries(record):
+        yield queries
+
+@contextmanager
+def removing_new_files(folders):
+    """Deletes the files created in `folders` inside the block, and the
+    folders themselves if they were created and are left empty"""
+    before = {f: set(os.listdir(f)) if os.path.isdir(f) else None for f in folders}
+    try:
+        yield
+    finally:
+        for folder, names in before.items():
+            if not os.path.isdir(folder):
+                continue
+            for name in set(os.listdir(folder)) - (names or set()):
+                path = os.path.join(folder, name)
+                if os.path.isfile(path):
+                    os.remove(path)
+            if names is None and not os.listdir(folder):
+                os.rmdir(folder)
+
+def summarize_queries(queries):
+    """Groups queries by statement and location, slowest total first"""
+    groups = {}
+    for q in queries:
+        g = groups.setdefault((q["sql"], q["location"]), {"sql": q["sql"],
+                                                          "location": q["location"],
+                                                          "count": 0,
+                                                          "time": 0.0})
+        g["count"] += 1
+        g["time"] += q["time"]
+    return sorted(groups.values(), key=lambda g: g["time"], reverse=True)
+
+class StackSampler():
+    """Samples a thread's stack every `interval` seconds from a background thread"""
+    def __init__(self, thread_id=None, interval=0.001):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id) #pylint: disable=protected-access
+        names = []
+        while frame:
+            code = frame.f_code
+            filename = os.path.basename(code.co_filename)
+            names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if names:
+            key = ";".join(reversed(names))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def write_folded(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
@@ -0,0 +1,109 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from plugins.eschol import metrics
+from plugins.eschol.models import RateLimitBucket
+
+from utils.logger import get_logger
+logger = get_logger(__name__)
+
+# Token buckets shared by every process that calls the eScholarship API.
+# ESCHOL_RATE_LIMITS maps a kind of call to the number of calls per second
+# allowed across all workers, e.g. {"deposit": 2, "mint": 5, "issue": 1}.
+# Kinds without a rate aren't limited.  Buckets are rows in the database
+# unless ESCHOL_RATE_LIMIT_CACHE names a shared django cache.
+KINDS = {"depositItem": "deposit",
+         "mintProvisionalID": "mint",
+         "updateIssue": "issue"}
+DEFAULT_KIND = "query"
+
+def get_query_kind(query):
+    for name, kind in KINDS.items():
+        if name in query:
+            return kind
+    return DEFAULT_KIND
+
+def get_rate(kind):
+    rates = getattr(settings, "ESCHOL_RATE_LIMITS", {}) or {}
+    rate = rates.get(kind)
+    return float(rate) if rate else None
+
+def get_burst():
+    """Number of calls that can be made at once after a quiet period"""
+    return max(float(getattr(settings, "ESCHOL_RATE_LIMIT_BURST", 1)), 1.0)
+
+def reserve_db(kind, rate, n=1):
+    """Takes n tokens from the kind's bucket, returns how long to wait before using them.
+
+    The bucket may go negative, which reserves a slot in the future, so the
+    row is only locked while the bucket is updated and not while waiting.
+    """
+    burst = get_burst()
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                now = timezone.now()
+                bucket, _ = RateLimitBucket.objects.select_for_update()\
+                                                   .get_or_create(kind=kind,
+                                                                  defaults={"tokens": burst,
+                                                                            "updated": now})
+                elapsed = max((now - bucket.updated).total_seconds(), 0)
+                bucket.tokens = min(burst, bucket.tokens + elapsed * rate) - n
+                bucket.updated = now
+                bucket.save()
+            return max(-bucket.tokens / rate, 0)
+        except IntegrityError:
+            # another process created the bucket first
+            continue
+    return 0
+
+def reserve_cache(cache, kind, rate, n=1):
+    """Counts calls in fixed windows in a shared cache, returns how long to wait.
+
+    More than a window's worth of calls at once are let through when they
+    are the first in their window, otherwise they'd never fit.
+    """
+    window = max(1.0, 1 / rate)
+    allowed = max(1, int(rate * window))
+    waited = 0
+    while True:
+        now = time.time()
+        start = int(now // window)
+        key = f"eschol_rate_{kind}_{start}"
+        cache.add(key, 0, int(window) + 1)
+        try:
+            count = cache.incr(key, n)
+        except ValueError:
+            # expired between add and incr
+            continue
+        if count <= allowed or count == n:
+            return waited
+        delay = (start + 1) * window - now
+        time.sleep(delay)
+        waited += delay
+
+def acquire(kind, n=1):
+    """Waits until n calls of this kind are allowed, returns the seconds waited.
+
+    A batch request with n aliased mutations counts as n calls.
+    """
+    rate = get_rate(kind)
+    if not rate:
+        return 0
+
+    alias = getattr(settings, "ESCHOL_RATE_LIMIT_CACHE", None)
+    if alias:
+        waited = reserve_cache(caches[alias], kind, rate, n)
+    else:
+        waited = reserve_db(kind, rate, n)
+        if waited:
+            time.sleep(waited)
+
+    if waited:
+        logger.debug(f"Waited {waited:.3f}s for eScholarship {kind} rate limit")
+        metrics.add("rate_limit_wait", waited)
+    return waited
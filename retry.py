@@ -0,0 +1,155 @@
+import random, threading, time
+from contextlib import contextmanager
+
+import requests
+
+from django.conf import settings
+
+from plugins.eschol import circuit, metrics
+
+from utils.logger import get_logger
+logger = get_logger(__name__)
+
+# Sometimes submit throws a deadlock error that comes back in the
+# API text response (rather than as an error code or a proper json error message)
+# Once we move off of submit-style backend for the API we should be able
+# to remove this special case
+DEADLOCK_TEXT = "Mysql2::Error: Deadlock"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# responses that count towards opening the circuit breaker
+OUTAGE_STATUS = (500, 502, 503, 504)
+
+class EscholAPIError(Exception):
+    """An eScholarship API call that failed and won't be retried"""
+
+class CircuitOpen(EscholAPIError):
+    """The circuit breaker is open so the call wasn't sent"""
+
+class RetryDeferred(Exception):
+    """Raised instead of sleeping when the caller is a queued task that can
+    reschedule itself"""
+    def __init__(self, delay, reason):
+        super().__init__(f"eScholarship API {reason}, retry in {delay:.1f}s")
+        self.delay = delay
+        self.reason = reason
+
+_local = threading.local()
+
+@contextmanager
+def deferring(enabled=True):
+    """Long retry waits inside the block raise RetryDeferred instead of sleeping"""
+    previous = is_deferring()
+    _local.defer = enabled
+    try:
+        yield
+    finally:
+        _local.defer = previous
+
+def is_deferring():
+    return getattr(_local, "defer", False)
+
+@contextmanager
+def interactive(enabled=True):
+    """Calls inside the block are made while someone waits on a web request,
+    so they get the shorter ESCHOL_RETRY_INTERACTIVE_* policy"""
+    previous = is_interactive()
+    _local.interactive = enabled
+    try:
+        yield
+    finally:
+        _local.interactive = previous
+
+def is_interactive():
+    return getattr(_local, "interactive", False)
+
+def get_policy():
+    policy = {"max_attempts": getattr(settings, "ESCHOL_RETRY_MAX_ATTEMPTS", 5),
+              "base_delay": getattr(settings, "ESCHOL_RETRY_BASE_DELAY", 1),
+              "max_delay": getattr(settings, "ESCHOL_RETRY_MAX_DELAY", 60),
+              "budget": getattr(settings, "ESCHOL_RETRY_BUDGET", 120),
+              "sleep_max": getattr(settings, "ESCHOL_RETRY_SLEEP_MAX", 2)}
+    if is_interactive() and not is_deferring():
+        policy["max_attempts"] = getattr(settings, "ESCHOL_RETRY_INTERACTIVE_MAX_ATTEMPTS", 2)
+        policy["budget"] = getattr(settings, "ESCHOL_RETRY_INTERACTIVE_BUDGET", 10)
+    return policy
+
+def classify(response=None, error=None):
+    """Returns why a call should be retried, or None if it shouldn't be"""
+    if error is not None:
+        if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+            return f"{type(error).__name__}: {error}"
+        return None
+    status = getattr(response, "status_code", 200)
+    if status in RETRY_STATUS:
+        return f"HTTP {status}"
+    if DEADLOCK_TEXT in response.text:
+        return "deadlock"
+    return None
+
+def is_outage(response=None, error=None):
+    if error is not None:
+        return isinstance(error, (requests.Timeout, requests.ConnectionError))
+    return getattr(response, "status_code", 200) in OUTAGE_STATUS
+
+def check_circuit():
+    wait = circuit.allow()
+    if not wait:
+        return
+    reason = "unavailable (circuit open)"
+    if is_deferring():
+        raise RetryDeferred(wait, reason)
+    msg = f"eScholarship API {reason}, retry in {wait:.0f}s"
+    logger.warning(msg)
+    raise CircuitOpen(msg)
+
+def get_delay(attempt, policy):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(policy["max_delay"], policy["base_delay"] * 2 ** attempt))
+
+def call(func):
+    """Calls func until it returns a response that doesn't need retrying.
+
+    Raises EscholAPIError when the attempts or the time budget run out,
+    CircuitOpen when the circuit breaker is open and RetryDeferred instead
+    when deferring and the next wait is longer than ESCHOL_RETRY_SLEEP_MAX.
+    Retries and time spent waiting are added to the current metrics.
+    """
+    policy = get_policy()
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        check_circuit()
+        response = error = None
+        try:
+            response = func()
+        except Exception as e: #pylint: disable=broad-exception-caught
+            error = e
+
+        if is_outage(response, error):
+            circuit.record_failure(f"{type(error).__name__}: {error}" if error \
+                                   else f"HTTP {response.status_code}")
+        elif error is None:
+            circuit.record_success()
+
+        reason = classify(response, error)
+        if reason is None:
+            if error is not None:
+                raise error
+            return response
+
+        delay = get_delay(attempt, policy)
+        attempt += 1
+        if attempt >= policy["max_attempts"] or \
+           time.monotonic() - start + delay > policy["budget"]:
+            msg = f"eScholarship API {reason} after {attempt} attempts"
+            logger.error(msg)
+            raise EscholAPIError(msg) from error
+
+        if is_deferring() and delay > policy["sleep_max"]:
+            logger.info(f"eScholarship API {reason}, deferring for {delay:.1f}s")
+            raise RetryDeferred(delay, reason)
+
+        logger.info(f"eScholarship API {reason}, retrying in {delay:.1f}s")
+        metrics.add("retries", 1)
+        metrics.add("retry_time", delay)
+        time.sleep(delay)
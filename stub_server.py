@@ -0,0 +1,263 @@
+import json, random, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# A stand-in for the eScholarship GraphQL API for load and failure testing.
+# It answers the depositItem, mintProvisionalID, updateIssue and item
+# fields the plugin uses (aliased or not, several per request), fetches
+# every contentLink/fetchLink and cover image like the real service does, and
+# can be told to be slow, to fail or to cap its throughput.  Point
+# ESCHOL_API_URL at it, see the eschol_stub_server command.
+FIELD_RE = re.compile(r"(?:(\w+)\s*:\s*)?\b(depositItem|mintProvisionalID|updateIssue|item)"
+                      r"\s*\(\s*\w+\s*:\s*\$(\w+)\s*\)")
+LINK_KEYS = ("contentLink", "fetchLink")
+DEADLOCK_RESPONSE = "Mysql2::Error: Deadlock found when trying to get lock; " \
+                    "try restarting transaction"
+
+DISTRIBUTIONS = {"fixed": lambda rng, seconds: seconds,
+                 "uniform": lambda rng, low, high: rng.uniform(low, high),
+                 "normal": lambda rng, mu, sigma: rng.gauss(mu, sigma),
+                 "lognormal": lambda rng, mu, sigma: rng.lognormvariate(mu, sigma),
+                 "exponential": lambda rng, mean: rng.expovariate(1 / mean)}
+
+def parse_latency(spec):
+    """Parses a latency distribution in seconds, e.g. "0.05", "uniform:0.01,0.2",
+    "normal:0.1,0.02", "lognormal:-2.3,0.5" or "exponential:0.1".
+
+    Returns a function that takes a random.Random and returns a delay.
+    """
+    if not spec:
+        return lambda rng: 0
+    name, _, params = spec.partition(":") if ":" in spec else ("fixed", "", spec)
+    if name not in DISTRIBUTIONS:
+        raise ValueError(f"Unknown latency distribution {name}, "
+                         f"use one of {', '.join(DISTRIBUTIONS)}")
+    args = [float(p) for p in params.split(",")]
+    return lambda rng: max(DISTRIBUTIONS[name](rng, *args), 0)
+
+def get_links(value):
+    """Every contentLink/fetchLink in a deposit item"""
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if k in LINK_KEYS and v:
+                yield v
+            else:
+                yield from get_links(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from get_links(v)
+
+class StubError(Exception):
+    pass
+
+class StubAPI():
+    """The state and behaviour of a stub server.
+
+    latency maps a field name (or "default") to a distribution spec.  Each
+    request fails with a timeout, an HTTP error or a deadlock message with the
+    given probabilities, checked in that order.  max_rps caps the requests
+    answered per second: requests over the cap wait their turn, or get a 429
+    if reject_over_cap is set.
+    """
+    def __init__(self,
+                 latency=None,
+                 deadlock_rate=0,
+                 error_rate=0,
+                 timeout_rate=0,
+                 timeout=60,
+                 max_rps=None,
+                 reject_over_cap=False,
+                 fetch_links=True,
+                 fetch_timeout=30,
+                 seed=None):
+        self.latency = {name: parse_latency(spec) for name, spec in (latency or {}).items()}
+        self.deadlock_rate = deadlock_rate
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.max_rps = max_rps
+        self.reject_over_cap = reject_over_cap
+        self.fetch_links = fetch_links
+        self.fetch_timeout = fetch_timeout
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_slot = 0
+        self.ark_count = 0
+        self.items = {}
+        self.counts = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, items=len(self.items))
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def get_latency(self, name):
+        dist = self.latency.get(name, self.latency.get("default"))
+        if not dist:
+            return 0
+        with self.lock:
+            return dist(self.random)
+
+    def throttle(self):
+        """Waits for a slot under max_rps, returns False if the request is rejected"""
+        if not self.max_rps:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            if slot > now and self.reject_over_cap:
+                return False
+            self.next_slot = slot + 1 / self.max_rps
+        if slot > now:
+            self.count("throttled")
+            time.sleep(slot - now)
+        return True
+
+    def new_ark(self):
+        with self.lock:
+            self.ark_count += 1
+            return f"ark:/13030/qt{self.ark_count:08d}"
+
+    def fetch(self, url):
+        try:
+            r = requests.get(url, stream=True, timeout=self.fetch_timeout)
+            size = sum(len(chunk) for chunk in r.iter_content(65536))
+        except requests.RequestException as e:
+            self.count("fetch_errors")
+            raise StubError(f"Error fetching {url}: {e}") from e
+        self.count("fetches")
+        self.count("fetch_bytes", size)
+        if r.status_code != 200:
+            self.count("fetch_errors")
+            raise StubError(f"Error fetching {url}: HTTP {r.status_code}")
+
+    def deposit_item(self, item):
+        if self.fetch_links:
+            for url in get_links(item):
+                self.fetch(url)
+        ark = item.get("id") or self.new_ark()
+        with self.lock:
+            message = "Updated" if ark in self.items else "Deposited"
+            self.items[ark] = dict(item, id=ark)
+        return {"id": ark, "message": message}
+
+    def mint_provisional_id(self, _input):
+        return {"id": self.new_ark()}
+
+    def update_issue(self, issue):
+        if self.fetch_links and issue.get("coverImageURL"):
+            self.fetch(issue["coverImageURL"])
+        return {"message": "Cover Image uploaded"}
+
+    def get_item(self, ark):
+        with self.lock:
+            return self.items.get(ark)
+
+    def resolve(self, field, value):
+        time.sleep(self.get_latency(field))
+        self.count(field)
+        if field == "depositItem":
+            return self.deposit_item(value)
+        if field == "mintProvisionalID":
+            return self.mint_provisional_id(value)
+        if field == "updateIssue":
+            return self.update_issue(value)
+        return self.get_item(value)
+
+    def handle(self, body):
+        """Answers a GraphQL request body, returns (status, content type, text)"""
+        self.count("requests")
+        if not self.throttle():
+            self.count("rejected")
+            return 429, "text/plain", "Too Many Requests"
+
+        r = self.roll()
+        if r < self.timeout_rate:
+            # hang past the client's read timeout
+            self.count("timeouts")
+            time.sleep(self.timeout)
+            return 504, "text/plain", "Gateway Timeout"
+        r -= self.timeout_rate
+        if r < self.error_rate:
+            self.count("errors")
+            return 503, "text/plain", "Service Unavailable"
+        r -= self.error_rate
+        if r < self.deadlock_rate:
+            self.count("deadlocks")
+            return 200, "text/plain", DEADLOCK_RESPONSE
+
+        try:
+            request = json.loads(body)
+            query = request["query"]
+            variables = request.get("variables") or {}
+        except (ValueError, KeyError, TypeError):
+            return 400, "application/json", json.dumps({"errors": [{"message": "Bad request"}]})
+
+        data = {}
+        errors = []
+        for alias, field, var in FIELD_RE.findall(query):
+            alias = alias or field
+            try:
+                data[alias] = self.resolve(field, variables.get(var))
+            except StubError as e:
+                data[alias] = None
+                errors.append({"message": str(e), "path": [alias]})
+        result = {"data": data}
+        if errors:
+            result["errors"] = errors
+        return 200, "application/json", json.dumps(result)
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    def send(self, status, content_type, text):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self): #pylint: disable=invalid-name
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            self.send(*self.server.api.handle(self.rfile.read(length)))
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up waiting
+            pass
+
+    def do_GET(self): #pylint: disable=invalid-name
+        if self.path.rstrip("/").endswith("/stats"):
+            self.send(200, "application/json", json.dumps(self.server.api.stats()))
+        else:
+            self.send(404, "text/plain", "Not Found")
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api, verbose=False):
+        super().__init__(address, StubRequestHandler)
+        self.api = api
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/graphql"
+
+def start(api, host="127.0.0.1", port=0, verbose=False):
+    """Serves the stub API in a background thread, call shutdown() on the
+    returned server to stop it"""
+    server = StubServer((host, port), api, verbose=verbose)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,13 @@
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+@contextmanager
+def assert_query_budget(testcase, budget):
+    """Fails the test if the block runs more than `budget` queries, listing them"""
+    with CaptureQueriesContext(connection) as context:
+        yield context
+    queries = "\n".join([q["sql"] for q in context.captured_queries])
+    testcase.assertLessEqual(len(context), budget,
+                             f"{len(context)} queries, over the budget of {budget}:\n{queries}")
@@ -1,17 +1,20 @@
-import os, json
+import os, json, sys, time
 
 from unittest.mock import patch
-from datetime import datetime
+from datetime import datetime, timedelta
 import mock
+import requests
 
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.conf import settings
 from django.utils import timezone
 from django.core.files.uploadedfile import SimpleUploadedFile
-from journal.models import ArticleOrdering
+from journal.models import ArticleOrdering, SectionOrdering
 
 from submission.models import STAGE_PUBLISHED, Licence, Keyword, Field, FieldAnswer
-from submission.models import FrozenAuthor
+from submission.models import Article, FrozenAuthor
 
 import utils
 from utils.testing import helpers
@@ -21,9 +24,16 @@ from core.files import save_file
 # these imports are needed to make sure plugin urls are loaded
 from core import models as core_models, urls # pylint: disable=unused-import
 from identifiers.models import Identifier
+from django_q.models import Schedule
 
-from plugins.eschol import logic
-from plugins.eschol.models import EscholArticle, IssuePublicationHistory, ArticlePublicationHistory
+from plugins.eschol.tests.query_budget import assert_query_budget
+from plugins.eschol import (logic, circuit, client, metrics, ratelimit, retry, stub_server,
+                            unit_cache)
+from plugins.eschol.models import (EscholArticle,
+                                   IssuePublicationHistory,
+                                   ArticlePublicationHistory,
+                                   CircuitBreaker,
+                                   JournalUnit)
 
 TEST_XML = """<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE article PUBLIC "-//NLM//DTD JATS (Z39.96) Journal Publishing DTD v1.2 20120330//EN" "http://jats.nlm.nih.gov/publishing/1.2/JATS-journalpublishing1.dtd">
@@ -42,8 +52,9 @@ DEPOSIT_RESULT = """Escholarhip Deposit for Article {0}: \
 
 
 class Response():
-    def __init__(self, text):
+    def __init__(self, text, status_code=200):
         self.text = text
+        self.status_code = status_code
 
     def has_header(self):
         return False
@@ -56,6 +67,7 @@ class EscholConnectorTest(TestCase):
     def setUp(self):
         # unconfigure ESCHOL API to start
         del settings.ESCHOL_API_URL
+        unit_cache.clear()
 
         self.user = helpers.create_user("user1@test.edu")
         self.request = helpers.Request()
@@ -507,10 +519,11 @@ class EscholConnectorTest(TestCase):
         ESCHOL_ACCESS_TOKEN="testtest",
         ESCHOL_PRIV_KEY="key",
         JSCHOL_URL="test.test/",
-        ESCHOL_SLEEP_MAX=20
+        ESCHOL_RETRY_MAX_ATTEMPTS=2
     )
-    @mock.patch('plugins.eschol.logic.requests.post')
-    def test_eschol_deadlock(self, mock_send):
+    @mock.patch('plugins.eschol.retry.time.sleep')
+    @mock.patch('plugins.eschol.client.post')
+    def test_eschol_deadlock(self, mock_send, mock_sleep):
         issue = helpers.create_issue(self.journal, articles=[self.article])
         self.article.primary_issue = issue
         self.article.issues.add(issue)
@@ -520,6 +533,7 @@ class EscholConnectorTest(TestCase):
 
         apub = logic.article_to_eschol(article=self.article)
         assert mock_send.call_count == 2
+        assert mock_sleep.call_count == 1
         self.assertFalse(apub.success)
 
     @mock.patch('plugins.eschol.logic.send_to_eschol')
@@ -681,7 +695,7 @@ class EscholConnectorTest(TestCase):
     def test_issue_unexpected_error(self, mock_send):
         issue = helpers.create_issue(self.journal, articles=[self.article])
         apub = logic.issue_to_eschol(issue=issue)
-        mock_send.assert_called_once_with(issue, False)
+        mock_send.assert_called_once_with(issue, False, force=False)
         self.assertFalse(apub.success)
         error_text = f"An unexpected error occured when sending {issue} to eScholarship: Boom!"
         self.assertEqual(apub.result, error_text)
@@ -701,3 +715,654 @@ class EscholConnectorTest(TestCase):
         mock_send.return_value = Response(json.dumps(result_json))
         ark = logic.get_provisional_id(self.article)
         self.assertEqual(ark, "ark:/13030/qtAAAAAAAA")
+
+    def test_session_reused(self):
+        client.close_session()
+        session = client.get_session()
+        self.assertIs(client.get_session(), session)
+        stats = client.pool_stats()
+        self.assertEqual(stats["handshakes"], 0)
+        self.assertEqual(stats["reused"], 0)
+        client.close_session()
+        self.assertIsNot(client.get_session(), session)
+
+    @mock.patch('plugins.eschol.logic.send_article')
+    def test_issue_to_eschol_workers(self, mock_send):
+        d = datetime(2023, 1, 1, tzinfo=timezone.get_current_timezone())
+        article2 = helpers.create_article(self.journal,
+                                          with_author=False,
+                                          date_published=d,
+                                          stage=STAGE_PUBLISHED,
+                                          language=None)
+        issue = helpers.create_issue(self.journal, articles=[self.article, article2])
+        apubs = {self.article.pk: ArticlePublicationHistory.objects.create(article=self.article,
+                                                                           success=True),
+                 article2.pk: ArticlePublicationHistory.objects.create(article=article2,
+                                                                       success=False)}
+        mock_send.side_effect = lambda a, *args, **kwargs: apubs[a.pk]
+
+        ipub = logic.issue_to_eschol(issue=issue, workers=2)
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertTrue(ipub.is_complete)
+        self.assertFalse(ipub.success)
+        self.assertEqual(ipub.articlepublicationhistory_set.all().count(), 2)
+        self.assertEqual(ipub.articlepublicationhistory_set.filter(success=True).count(), 1)
+
+    @mock.patch('plugins.eschol.logic.send_article')
+    def test_issue_to_eschol_workers_deferred(self, mock_send):
+        issue, articles = self.create_issue_articles(3)
+        apubs = {a.pk: ArticlePublicationHistory.objects.create(article=a, success=True)
+                 for a in articles}
+        def send(a, *args, **kwargs):
+            if a == articles[1]:
+                raise retry.RetryDeferred(30, "HTTP 429")
+            return apubs[a.pk]
+        mock_send.side_effect = send
+
+        with retry.deferring():
+            with self.assertRaises(retry.RetryDeferred):
+                logic.issue_to_eschol(issue=issue, workers=2)
+        ipub = IssuePublicationHistory.objects.get(issue=issue)
+        self.assertFalse(ipub.is_complete)
+        # what other threads sent is recorded so a resume doesn't send it again
+        sent = [args[0][0] for args in mock_send.call_args_list if args[0][0] != articles[1]]
+        self.assertIn(articles[0], sent)
+        self.assertEqual(set(ipub.articlepublicationhistory_set.values_list("article", flat=True)),
+                         set(a.pk for a in sent))
+
+    def create_issue_articles(self, n):
+        d = datetime(2023, 1, 1, tzinfo=timezone.get_current_timezone())
+        articles = [self.article]
+        for _ in range(n - 1):
+            a = helpers.create_article(self.journal,
+                                       with_author=False,
+                                       date_published=d,
+                                       stage=STAGE_PUBLISHED,
+                                       language=None)
+            a.owner = self.user
+            a.save()
+            articles.append(a)
+        issue = helpers.create_issue(self.journal, articles=articles)
+        for a in articles:
+            a.primary_issue = issue
+            a.save()
+        return issue, articles
+
+    @override_settings(ESCHOL_API_URL="test", JSCHOL_URL="test.test/")
+    @mock.patch('plugins.eschol.logic.send_to_eschol')
+    def test_send_article_batch(self, mock_send):
+        _issue, articles = self.create_issue_articles(3)
+        result_json = {'data': {'item0': {'message': 'Deposited', 'id': 'ark:/13030/qtAAAAAAAA'},
+                                'item1': None,
+                                'item2': {'message': 'Deposited', 'id': 'ark:/13030/qtCCCCCCCC'}},
+                       'errors': [{'message': 'Bad item', 'path': ['item1']}]}
+        mock_send.return_value = Response(json.dumps(result_json))
+
+        apubs = logic.send_article_batch(articles, configured=True)
+        mock_send.assert_called_once()
+        query, variables = mock_send.call_args[0]
+        self.assertIn("item2: depositItem(input: $item2)", query)
+        self.assertEqual(variables["item1"]["sourceID"], str(articles[1].pk))
+        self.assertEqual([apub.article for apub in apubs], articles)
+        self.assertEqual([apub.success for apub in apubs], [True, False, True])
+        self.assertIn("Bad item", apubs[1].result)
+        self.assertEqual(EscholArticle.objects.get(article=articles[2]).ark,
+                         'ark:/13030/qtCCCCCCCC')
+
+    @override_settings(ESCHOL_API_URL="test", JSCHOL_URL="test.test/")
+    @mock.patch('plugins.eschol.logic.send_to_eschol')
+    def test_send_article_batch_fallback(self, mock_send):
+        _issue, articles = self.create_issue_articles(2)
+        result_json = {'data': {'depositItem': {'message': 'Deposited',
+                                                'id': 'ark:/13030/qtAAAAAAAA'}}}
+        mock_send.side_effect = [Response("Internal Server Error"),
+                                 Response(json.dumps(result_json)),
+                                 Response(json.dumps(result_json))]
+
+        apubs = logic.send_article_batch(articles, configured=True)
+        self.assertEqual(mock_send.call_count, 3)
+        self.assertEqual(mock_send.call_args_list[1][0][0], logic.DEPOSIT_QUERY)
+        self.assertTrue(all(apub.success for apub in apubs))
+
+    @override_settings(ESCHOL_API_URL="test", ESCHOL_MINT_BATCH_SIZE=2)
+    @mock.patch('plugins.eschol.logic.send_to_eschol')
+    def test_mint_provisional_ids(self, mock_send):
+        _issue, articles = self.create_issue_articles(3)
+        EscholArticle.objects.create(article=articles[0], ark="ark:/13030/qt00000000")
+
+        def mint(query, variables):
+            self.assertIn("mintProvisionalID(input:", query)
+            data = {alias: {"id": f"ark:/13030/qt{v['sourceID']}"}
+                    for alias, v in variables.items()}
+            return Response(json.dumps({"data": data}))
+        mock_send.side_effect = mint
+
+        epubs = logic.mint_provisional_ids(articles)
+        # one request for the two articles without an ark
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(len(epubs), 2)
+        for a in articles[1:]:
+            self.assertEqual(EscholArticle.objects.get(article=a).ark, f"ark:/13030/qt{a.pk}")
+        self.assertEqual(EscholArticle.objects.get(article=articles[0]).ark,
+                         "ark:/13030/qt00000000")
+
+    def test_normalize_html(self):
+        html = """<html><head><meta charset="utf-8"><style>p > a { color: red }</style></head>
+<body><article id="main_article"><p title="a&b">&eacute; <b>a</b> <i>b</i><br>
+<table><tr><td>1<td>2</table><script>var a = 1 < 2;</script></article></body></html>"""
+        s = html.encode("utf-8")
+        output = logic.normalize_html(s, backend="lxml")
+        self.assertTrue(output.startswith(logic.XML_DECLARATION))
+        self.assertIn(b'<p title="a&amp;b">\xc3\xa9 <b>a</b> <i>b</i><br/>', output)
+        self.assertIn(b"<script><![CDATA[var a = 1 < 2;]]></script>", output)
+        self.assertEqual(output, logic.normalize_html(s, backend="xmllint"))
+
+    def test_xml_to_html_cached(self):
+        xml_filepath = f'{os.path.dirname(__file__)}/test_files/glossa_test.xml'
+        with open(xml_filepath, 'rb') as f:
+            xml_file = SimpleUploadedFile("test.xml", f.read())
+        xml_obj = self.create_file(self.article, xml_file, "Test XML File")
+        galley = helpers.create_galley(self.article, file_obj=xml_obj)
+        self.article.render_galley = galley
+        self.article.save()
+
+        j1, _ = logic.get_article_json(self.article, logic.get_unit(self.journal))
+        html_file = File.objects.get(original_filename="qtXXXXXXXX.html")
+        epub = EscholArticle.objects.get(article=self.article)
+        self.assertIsNotNone(epub.html_cache_key)
+
+        with mock.patch('plugins.eschol.logic.render_galley_html') as mock_render:
+            j2, _ = logic.get_article_json(self.article, logic.get_unit(self.journal))
+            mock_render.assert_not_called()
+        self.assertEqual(File.objects.get(original_filename="qtXXXXXXXX.html").pk, html_file.pk)
+        self.assertEqual(j1["contentFileName"], j2["contentFileName"])
+
+        # changing the journal's default css invalidates the cached HTML
+        JournalUnit.objects.create(journal=self.journal,
+                                   unit="TST",
+                                   default_css_url="https://test.test/test.css")
+        j3, _ = logic.get_article_json(self.article, logic.get_unit(self.journal))
+        new_file = File.objects.get(original_filename="qtXXXXXXXX.html")
+        self.assertNotEqual(new_file.pk, html_file.pk)
+        self.assertIn(f"/file/{new_file.pk}/", j3["contentLink"])
+
+    @override_settings(ESCHOL_API_URL="test", JSCHOL_URL="test.test/")
+    @mock.patch('plugins.eschol.logic.send_to_eschol')
+    def test_unchanged_deposit(self, mock_send):
+        issue = helpers.create_issue(self.journal, articles=[self.article])
+        self.article.primary_issue = issue
+        self.article.save()
+        pdf_file = SimpleUploadedFile("test.pdf", b"\x00\x01\x02\x03")
+        pdf_obj = self.create_file(self.article, pdf_file, "Test PDF File")
+        self.article.supplementary_files.add(SupplementaryFile.objects.create(file=pdf_obj))
+
+        result_json = {'data': {'depositItem': {'message': 'Deposited',
+                                                'id': 'ark:/13030/qtAAAAAAAA'}}}
+        mock_send.return_value = Response(json.dumps(result_json))
+
+        apub1 = logic.article_to_eschol(article=self.article)
+        self.assertTrue(apub1.success)
+        self.assertIsNotNone(apub1.payload_digest)
+
+        # the second deposit has new access tokens but is otherwise the same
+        apub2 = logic.article_to_eschol(article=self.article)
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertTrue(apub2.success)
+        self.assertEqual(apub2.result, logic.UNCHANGED)
+        self.assertEqual(apub2.payload_digest, apub1.payload_digest)
+
+        apub3 = logic.article_to_eschol(article=self.article, force=True)
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertIsNone(apub3.result)
+
+        self.article.title = "A new title"
+        self.article.save()
+        apub4 = logic.article_to_eschol(article=self.article)
+        self.assertEqual(mock_send.call_count, 3)
+        self.assertNotEqual(apub4.payload_digest, apub1.payload_digest)
+
+    def test_payload_digest_ignores_access(self):
+        item1 = {"title": "T", "suppFiles": [{"fetchLink": "http://test/1/?access=abc"}]}
+        item2 = {"suppFiles": [{"fetchLink": "http://test/1/?access=def"}], "title": "T"}
+        item3 = {"title": "T", "suppFiles": [{"fetchLink": "http://test/2/?access=abc"}]}
+        self.assertEqual(logic.get_payload_digest(item1), logic.get_payload_digest(item2))
+        self.assertNotEqual(logic.get_payload_digest(item1), logic.get_payload_digest(item3))
+
+    def create_issue_json_articles(self, n):
+        issue, articles = self.create_issue_articles(n)
+        SectionOrdering.objects.create(issue=issue, section=self.article.section, order=0)
+        for i, a in enumerate(articles):
+            a.keywords.add(Keyword.objects.create(word=f"keyword{i}"))
+            FrozenAuthor.objects.create(article=a, first_name="A", last_name=f"Author{i}", order=1)
+            Identifier.objects.create(id_type="doi", identifier=f"10.00000/{i}", article=a)
+            EscholArticle.objects.create(article=a, ark=f"ark:/13030/qt0000000{i}")
+        return issue, articles
+
+    def test_issue_article_json_queries(self):
+        issue, articles = self.create_issue_json_articles(3)
+
+        def issue_json(pks):
+            qs = Article.objects.filter(pk__in=pks).order_by("pk")
+            return logic.get_issue_article_json(issue, list(logic.prefetch_articles(qs)))
+
+        with CaptureQueriesContext(connection) as one:
+            issue_json([articles[0].pk])
+        with CaptureQueriesContext(connection) as three:
+            results = issue_json([a.pk for a in articles])
+
+        self.assertEqual(len(one), len(three))
+        self.assertEqual([a for a, _, _ in results], articles)
+        for a, item, epub in results:
+            expected, expected_epub = logic.get_article_json(a, logic.get_unit(self.journal))
+            self.assertEqual(item, expected)
+            self.assertEqual(epub, expected_epub)
+            self.assertEqual(item["authors"][0]["nameParts"]["lname"],
+                             f"Author{articles.index(a)}")
+
+    def test_issue_ordering_index(self):
+        issue, articles = self.create_issue_articles(4)
+        section = helpers.create_section(journal=self.journal,
+                                         name="Section 2",
+                                         plural="Section 2s")
+        for a in articles[2:]:
+            a.section = section
+            a.save()
+        ArticleOrdering.objects.filter(issue=issue).delete()
+        SectionOrdering.objects.filter(issue=issue).delete()
+
+        ordering = logic.get_issue_ordering(issue)
+        self.assertEqual(set(ordering["articles"]), set(a.pk for a in articles))
+
+        # matches the per-article lookup used for articles outside the index
+        empty = {"issue": issue.pk, "articles": {}}
+        for a in articles:
+            self.assertEqual(ordering["articles"][a.pk], logic.get_article_order(a, issue, empty))
+
+        j, _ = logic.get_article_json(articles[3], logic.get_unit(self.journal), ordering=ordering)
+        self.assertEqual(j["sectionHeader"], "Section 2s")
+        self.assertEqual(j["orderInSection"] // 10000, ordering["articles"][articles[3].pk][0])
+
+    def test_article_order_looked_up_once(self):
+        issue, articles = self.create_issue_articles(3)
+        with mock.patch('plugins.eschol.logic.get_issue_ordering') as mock_ordering, \
+             mock.patch('plugins.eschol.logic.lookup_article_order',
+                        wraps=logic.lookup_article_order) as mock_order:
+            logic.send_article(articles[1])
+        mock_ordering.assert_not_called()
+        self.assertEqual(mock_order.call_count, 1)
+        self.assertEqual(mock_order.call_args[0][:2], (articles[1], issue))
+
+    def test_journal_unit_cache(self):
+        self.assertEqual(logic.get_unit(self.journal), self.journal.code)
+        ju = JournalUnit.objects.create(journal=self.journal,
+                                        unit="TST",
+                                        default_css_url="https://test.test/test.css")
+        self.assertEqual(logic.get_unit(self.journal), "TST")
+        with self.assertNumQueries(0):
+            self.assertEqual(logic.get_unit(self.journal), "TST")
+            self.assertEqual(logic.get_default_css_url(self.journal), "https://test.test/test.css")
+
+        ju.unit = "TST2"
+        ju.save()
+        self.assertEqual(logic.get_unit(self.journal), "TST2")
+        ju.delete()
+        self.assertEqual(logic.get_unit(self.journal), self.journal.code)
+
+        stats = unit_cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(stats["invalidations"], 3)
+
+    def test_incremental_issue(self):
+        issue, articles = self.create_issue_articles(2)
+        state_digest = logic.get_state_digest(articles[0])
+        ArticlePublicationHistory.objects.create(article=articles[0],
+                                                 success=True,
+                                                 state_digest=state_digest)
+        ArticlePublicationHistory.objects.create(article=articles[1],
+                                                 success=True,
+                                                 state_digest=logic.get_state_digest(articles[1]))
+        articles[1].keywords.add(Keyword.objects.create(word="changed"))
+
+        modified, not_modified = logic.split_modified_articles(logic.get_issue_articles(issue))
+        self.assertEqual(modified, [articles[1]])
+        self.assertEqual(not_modified, [(articles[0], state_digest)])
+
+        with mock.patch('plugins.eschol.logic.send_article') as mock_send:
+            mock_send.side_effect = lambda a, *args, **kwargs: \
+                ArticlePublicationHistory.objects.create(article=a, success=True)
+            ipub = logic.issue_to_eschol(issue=issue, incremental=True)
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(mock_send.call_args[0][0], articles[1])
+        self.assertTrue(ipub.success)
+        self.assertEqual(ipub.total_articles, 2)
+        skipped = ipub.articlepublicationhistory_set.get(article=articles[0])
+        self.assertEqual(skipped.result, logic.NOT_MODIFIED)
+
+    @override_settings(ESCHOL_RATE_LIMITS={"deposit": 2})
+    @mock.patch('plugins.eschol.ratelimit.time.sleep')
+    def test_rate_limit(self, mock_sleep):
+        self.assertEqual(ratelimit.get_query_kind(logic.DEPOSIT_QUERY), "deposit")
+        self.assertEqual(ratelimit.get_query_kind(logic.MINT_QUERY), "mint")
+        self.assertEqual(ratelimit.acquire("mint"), 0)
+
+        # the first call uses the full bucket, the ones after it wait their turn
+        self.assertEqual(ratelimit.acquire("deposit"), 0)
+        self.assertAlmostEqual(ratelimit.acquire("deposit"), 0.5, places=1)
+        self.assertAlmostEqual(ratelimit.acquire("deposit"), 1.0, places=1)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+        # a batch takes a token per item
+        self.assertAlmostEqual(ratelimit.acquire("deposit", 4), 3.0, places=1)
+        self.assertAlmostEqual(ratelimit.acquire("deposit"), 3.5, places=1)
+
+    @override_settings(ESCHOL_API_URL="test",
+                       ESCHOL_ACCESS_TOKEN="testtest",
+                       ESCHOL_PRIV_KEY="key",
+                       JSCHOL_URL="test.test/",
+                       ESCHOL_RATE_LIMITS={"deposit": 1})
+    @mock.patch('plugins.eschol.ratelimit.time.sleep')
+    @mock.patch('plugins.eschol.client.post')
+    def test_rate_limit_wait_recorded(self, mock_post, _mock_sleep):
+        _issue, articles = self.create_issue_articles(2)
+        result_json = {'data': {'depositItem': {'message': 'Deposited',
+                                                'id': 'ark:/13030/qtAAAAAAAA'}}}
+        mock_post.return_value = Response(json.dumps(result_json))
+
+        apub1 = logic.send_article(articles[0], configured=True)
+        apub2 = logic.send_article(articles[1], configured=True)
+        self.assertIsNone(apub1.rate_limit_wait)
+        apub2.refresh_from_db()
+        self.assertGreater(apub2.rate_limit_wait, 0.5)
+
+    @override_settings(ESCHOL_API_URL="test",
+                       ESCHOL_ACCESS_TOKEN="testtest",
+                       ESCHOL_PRIV_KEY="key",
+                       JSCHOL_URL="test.test/")
+    @mock.patch('plugins.eschol.retry.time.sleep')
+    @mock.patch('plugins.eschol.client.post')
+    def test_retry_server_error(self, mock_post, mock_sleep):
+        _issue, articles = self.create_issue_articles(1)
+        result_json = {'data': {'depositItem': {'message': 'Deposited',
+                                                'id': 'ark:/13030/qtAAAAAAAA'}}}
+        mock_post.side_effect = [Response("Bad Gateway", status_code=502),
+                                 Response("Service Unavailable", status_code=503),
+                                 Response(json.dumps(result_json))]
+
+        apub = logic.send_article(articles[0], configured=True)
+        self.assertTrue(apub.success)
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        apub.refresh_from_db()
+        self.assertEqual(apub.retry_count, 2)
+
+    @override_settings(ESCHOL_RETRY_BASE_DELAY=30, ESCHOL_RETRY_SLEEP_MAX=0)
+    @mock.patch('plugins.eschol.retry.time.sleep')
+    def test_retry_deferred(self, mock_sleep):
+        post = mock.Mock(return_value=Response("", status_code=429))
+        with retry.deferring():
+            with self.assertRaises(retry.RetryDeferred):
+                retry.call(post)
+        mock_sleep.assert_not_called()
+
+        # outside of a queued task the wait runs out the budget instead
+        with override_settings(ESCHOL_RETRY_BUDGET=0):
+            with self.assertRaises(retry.EscholAPIError):
+                retry.call(post)
+        mock_sleep.assert_not_called()
+
+    @mock.patch('plugins.eschol.retry.time.sleep')
+    def test_retry_interactive(self, mock_sleep):
+        post = mock.Mock(side_effect=requests.Timeout("Read timed out"))
+        with retry.interactive():
+            with self.assertRaises(retry.EscholAPIError):
+                retry.call(post)
+        self.assertEqual(post.call_count, 2)
+
+        # deferring tasks keep the full policy
+        with retry.interactive(), retry.deferring(), \
+             override_settings(ESCHOL_RETRY_MAX_ATTEMPTS=3, ESCHOL_RETRY_SLEEP_MAX=60):
+            with self.assertRaises(retry.EscholAPIError):
+                retry.call(post)
+        self.assertEqual(post.call_count, 5)
+        self.assertEqual(mock_sleep.call_count, 3)
+
+    @mock.patch('plugins.eschol.logic.send_article_batch')
+    def test_retry_deferred_workers(self, mock_batch):
+        _issue, articles = self.create_issue_articles(2)
+        deferring = []
+        def send(batch, *args, **kwargs):
+            deferring.append(retry.is_deferring())
+            raise retry.RetryDeferred(30, "HTTP 429")
+        mock_batch.side_effect = send
+
+        # pool threads defer when the task that started them does
+        with retry.deferring():
+            with self.assertRaises(retry.RetryDeferred):
+                list(logic.send_articles(articles, workers=2))
+        self.assertEqual(deferring, [True, True])
+
+    @override_settings(ESCHOL_API_URL="test",
+                       ESCHOL_ACCESS_TOKEN="testtest",
+                       ESCHOL_PRIV_KEY="key",
+                       JSCHOL_URL="test.test/",
+                       ESCHOL_RETRY_MAX_ATTEMPTS=1,
+                       ESCHOL_CIRCUIT_FAILURE_THRESHOLD=2,
+                       ESCHOL_CIRCUIT_RESET_TIMEOUT=60)
+    @mock.patch('plugins.eschol.retry.time.sleep')
+    @mock.patch('plugins.eschol.client.post')
+    def test_circuit_breaker(self, mock_post, _mock_sleep):
+        _issue, articles = self.create_issue_articles(3)
+        mock_post.side_effect = requests.ConnectionError("Connection refused")
+
+        logic.send_article(articles[0], configured=True)
+        logic.send_article(articles[1], configured=True)
+        calls = mock_post.call_count
+        self.assertEqual(circuit.stats()["state"], "Open")
+
+        # fails without calling the API
+        apub = logic.send_article(articles[2], configured=True)
+        self.assertFalse(apub.success)
+        self.assertIn("circuit open", apub.result)
+        self.assertEqual(mock_post.call_count, calls)
+
+        # queued tasks are deferred instead
+        with retry.deferring():
+            with self.assertRaises(retry.RetryDeferred):
+                logic.send_article(articles[2], configured=True)
+
+        # after the reset timeout a probe is let through and closes the circuit
+        CircuitBreaker.objects.update(opened=timezone.now() - timedelta(seconds=61))
+        result_json = {'data': {'depositItem': {'message': 'Deposited',
+                                                'id': 'ark:/13030/qtAAAAAAAA'}}}
+        mock_post.side_effect = None
+        mock_post.return_value = Response(json.dumps(result_json))
+        apub = logic.send_article(articles[2], configured=True)
+        self.assertTrue(apub.success)
+        self.assertEqual(circuit.stats(), {"state": "Closed", "failures": 0, "retry_in": None})
+
+    @override_settings(ESCHOL_API_URL="test",
+                       ESCHOL_ACCESS_TOKEN="testtest",
+                       ESCHOL_PRIV_KEY="key",
+                       JSCHOL_URL="test.test/")
+    @mock.patch('plugins.eschol.client.post')
+    def test_deposit_timings(self, mock_post):
+        issue, articles = self.create_issue_articles(2)
+        result_json = {'data': {'depositItem': {'message': 'Deposited',
+                                                'id': 'ark:/13030/qtAAAAAAAA'}}}
+        mock_post.return_value = Response(json.dumps(result_json))
+
+        apub = logic.send_article(articles[0], configured=True)
+        apub.refresh_from_db()
+        for stage in ["json", "deposit", "other", "total"]:
+            self.assertIn(stage, apub.timings)
+        stages = [v for k, v in apub.timings.items() if k != "total"]
+        self.assertAlmostEqual(apub.timings["total"], sum(stages), places=3)
+        self.assertTrue(apub.timings_text().startswith(f"{apub.timings['total']:.3f}s ("))
+
+        # nested timers only count towards the innermost stage
+        with metrics.collecting() as values:
+            with metrics.timer("json"):
+                with metrics.timer("xslt"):
+                    time.sleep(0.02)
+        self.assertGreaterEqual(values["xslt"], 0.02)
+        self.assertLess(values["json"], 0.02)
+
+        ipub = IssuePublicationHistory.objects.create(issue=issue)
+        ArticlePublicationHistory.objects.create(article=articles[0], issue_pub=ipub, success=True,
+                                                 timings={"json": 0.5,
+                                                          "deposit": 1.0,
+                                                          "total": 1.5})
+        ArticlePublicationHistory.objects.create(article=articles[1], issue_pub=ipub, success=True,
+                                                 timings={"json": 0.25, "xslt": 2.0, "total": 2.25})
+        logic.record_issue_timings(ipub)
+        self.assertEqual(ipub.timings, {"articles": 2,
+                                        "total": 3.75,
+                                        "stages": {"json": 0.75, "deposit": 1.0, "xslt": 2.0},
+                                        "slowest": {"article": articles[1].pk, "total": 2.25}})
+        self.assertEqual(ipub.timings_text(),
+                         "2 articles in 3.750s (xslt 2.000s, deposit 1.000s, json 0.750s); "
+                         f"slowest article {articles[1].pk} 2.250s")
+
+    @mock.patch('plugins.eschol.retry.time.sleep')
+    def test_stub_server(self, _mock_sleep):
+        _issue, articles = self.create_issue_articles(2)
+        api = stub_server.StubAPI(fetch_links=False, seed=1)
+        server = stub_server.start(api)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with self.settings(ESCHOL_API_URL=server.url,
+                           ESCHOL_ACCESS_TOKEN="testtest",
+                           ESCHOL_PRIV_KEY="key",
+                           JSCHOL_URL="test.test/",
+                           ESCHOL_RETRY_MAX_ATTEMPTS=2):
+            apubs = logic.send_article_batch(articles, configured=True)
+            self.assertTrue(all(apub.success for apub in apubs))
+            self.assertEqual(api.stats()["depositItem"], 2)
+
+            arks = {e.article_id: e.ark for e in EscholArticle.objects.filter(article__in=articles)}
+            self.assertEqual(len(set(arks.values())), 2)
+            self.assertEqual(api.get_item(arks[articles[0].pk])["sourceID"], str(articles[0].pk))
+
+            # every request fails
+            api.error_rate = 1
+            apub = logic.send_article(articles[0], configured=True, force=True)
+            self.assertFalse(apub.success)
+            self.assertEqual(api.stats()["errors"], 2)
+
+    @override_settings(ESCHOL_API_URL="test",
+                       ESCHOL_ACCESS_TOKEN="testtest",
+                       ESCHOL_PRIV_KEY="key",
+                       JSCHOL_URL="test.test/",
+                       ESCHOL_DEPOSIT_QUERY_BUDGET=1)
+    @mock.patch('plugins.eschol.client.post')
+    def test_deposit_query_count(self, mock_post):
+        _issue, articles = self.create_issue_articles(1)
+        result_json = {'data': {'depositItem': {'message': 'Deposited',
+                                                'id': 'ark:/13030/qtAAAAAAAA'}}}
+        mock_post.return_value = Response(json.dumps(result_json))
+
+        with mock.patch.object(logic.logger, "warning") as mock_warning:
+            with assert_query_budget(self, 80) as context:
+                apub = logic.send_article(articles[0], configured=True)
+        apub.refresh_from_db()
+        self.assertGreater(apub.query_count, 1)
+        # the publication history is updated after counting stops
+        self.assertLess(apub.query_count, len(context))
+        self.assertIsNotNone(apub.query_time)
+        mock_warning.assert_any_call(f"Deposit of article {articles[0].pk} ran "
+                                     f"{apub.query_count} queries in {apub.query_time:.3f}s, "
+                                     "over the budget of 1")
+
+    @override_settings(ESCHOL_API_URL="test",
+                       ESCHOL_ACCESS_TOKEN="testtest",
+                       ESCHOL_PRIV_KEY="key",
+                       JSCHOL_URL="test.test/")
+    @mock.patch('plugins.eschol.logic.register_doi')
+    @mock.patch('plugins.eschol.client.post')
+    def test_async_doi_registration(self, mock_post, mock_register):
+        _issue, articles = self.create_issue_articles(1)
+        Identifier.objects.create(id_type="doi", identifier="10.00000/1", article=articles[0])
+        result_json = {'data': {'depositItem': {'message': 'Deposited',
+                                                'id': 'ark:/13030/qtAAAAAAAA'}}}
+        mock_post.return_value = Response(json.dumps(result_json))
+
+        apub = logic.send_article(articles[0], configured=True)
+        self.assertTrue(apub.success)
+        mock_register.assert_not_called()
+        epub = EscholArticle.objects.get(article=articles[0])
+        self.assertTrue(epub.doi_pending)
+        self.assertEqual(Schedule.objects.filter(name=logic.DOI_SCHEDULE).count(), 1)
+
+        # a second deposit doesn't schedule the task again
+        logic.send_article(articles[0], configured=True, force=True)
+        self.assertEqual(Schedule.objects.filter(name=logic.DOI_SCHEDULE).count(), 1)
+
+        # the first attempt fails and is retried later
+        Schedule.objects.all().delete()
+        mock_register.return_value = False
+        self.assertEqual(logic.register_pending_dois(), "Registered 0 DOIs, 0 failed, 1 to retry")
+        epub.refresh_from_db()
+        self.assertTrue(epub.doi_pending)
+        self.assertEqual(epub.doi_attempts, 1)
+        self.assertGreater(epub.doi_next_attempt, timezone.now())
+        schedule = Schedule.objects.get(name=logic.DOI_SCHEDULE)
+        self.assertEqual(schedule.func, logic.DOI_TASK)
+        self.assertEqual(schedule.schedule_type, Schedule.ONCE)
+
+        # not due yet
+        self.assertEqual(logic.register_pending_dois(), "Registered 0 DOIs, 0 failed, 0 to retry")
+
+        EscholArticle.objects.filter(pk=epub.pk).update(doi_next_attempt=timezone.now())
+        mock_register.return_value = True
+        self.assertEqual(logic.register_pending_dois(), "Registered 1 DOIs, 0 failed, 0 to retry")
+        epub.refresh_from_db()
+        self.assertFalse(epub.doi_pending)
+        self.assertEqual(epub.doi_attempts, 2)
+        self.assertEqual(mock_register.call_count, 2)
+
+    @override_settings(ESCHOL_DOI_MAX_ATTEMPTS=1)
+    @mock.patch('plugins.eschol.logic.register_doi')
+    def test_async_doi_registration_fails(self, mock_register):
+        epub = EscholArticle.objects.create(article=self.article, ark="ark:/13030/qtXXXXXXXX")
+        logic.queue_doi_registration(epub)
+
+        mock_register.return_value = False
+        self.assertEqual(logic.register_pending_dois(), "Registered 0 DOIs, 1 failed, 0 to retry")
+        epub.refresh_from_db()
+        self.assertFalse(epub.doi_pending)
+        self.assertEqual(epub.doi_attempts, 1)
+
+    def test_register_doi_keeps_date_published(self):
+        epub = EscholArticle.objects.create(article=self.article, ark="ark:/13030/qtXXXXXXXX")
+        published = timezone.now() - timedelta(days=1)
+        EscholArticle.objects.filter(pk=epub.pk).update(date_published=published)
+        ezid = mock.Mock()
+        ezid.register_journal_doi.return_value = (True, True, "success: doi:10.00000/1")
+
+        logic.queue_doi_registration(epub)
+        with mock.patch.dict(sys.modules, {"plugins.ezid": mock.Mock(logic=ezid),
+                                           "plugins.ezid.logic": ezid}):
+            self.assertEqual(logic.register_pending_dois(),
+                             "Registered 1 DOIs, 0 failed, 0 to retry")
+        ezid.register_journal_doi.assert_called_once()
+        epub.refresh_from_db()
+        self.assertTrue(epub.is_doi_registered)
+        self.assertEqual(epub.doi_result_text, "success: doi:10.00000/1")
+        self.assertEqual(epub.date_published, published)
+
+    @mock.patch('plugins.eschol.logic.register_doi')
+    def test_async_doi_registration_overlap(self, mock_register):
+        epub = EscholArticle.objects.create(article=self.article, ark="ark:/13030/qtXXXXXXXX")
+        logic.queue_doi_registration(epub)
+
+        # a run that starts while another is registering skips its DOIs
+        overlapping = []
+        def register(*args):
+            overlapping.append(logic.register_pending_dois())
+            return True
+        mock_register.side_effect = register
+        self.assertEqual(logic.register_pending_dois(), "Registered 1 DOIs, 0 failed, 0 to retry")
+        self.assertEqual(overlapping, ["Registered 0 DOIs, 0 failed, 0 to retry"])
+        self.assertEqual(mock_register.call_count, 1)
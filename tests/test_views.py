@@ -1,6 +1,8 @@
+import os, time
 from datetime import datetime
 import mock
 from django.utils import timezone
+from django_q.models import Schedule
 from django.conf import settings
 
 from django.test import TestCase, override_settings
@@ -17,7 +19,8 @@ from submission.models import STAGE_PUBLISHED
 from plugins.eschol.models import (AccessToken,
                                    ArticlePublicationHistory,
                                    IssuePublicationHistory)
-from plugins.eschol.views import publish_issue_task
+from plugins.eschol.views import publish_issue_task, publish_issue_article_task
+from plugins.eschol import logic, retry, unit_cache
 
 TEST_XML = """<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE article PUBLIC "-//NLM//DTD JATS (Z39.96) Journal Publishing DTD v1.2 20120330//EN" "http://jats.nlm.nih.gov/publishing/1.2/JATS-journalpublishing1.dtd">
@@ -29,6 +32,7 @@ class TestViews(TestCase):
     def setUp(self):
         # unconfigure ESCHOL API to start
         del settings.ESCHOL_API_URL
+        unit_cache.clear()
 
         self.press = helpers.create_press()
 
@@ -65,6 +69,7 @@ class TestViews(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.headers['Location'], f"/login/?next={url}")
 
+    @override_settings(ESCHOL_ISSUE_FANOUT=False)
     @mock.patch('plugins.eschol.logic.send_article')
     def test_publish_issue_task(self, mock_send):
         mock_send.return_value = ArticlePublicationHistory.objects.create(article=self.article,
@@ -77,6 +82,139 @@ class TestViews(TestCase):
         msg = f"{self.issue} publication successful on {ipub.date}: 1 of 1 articles published."
         self.assertEqual(result, msg)
 
+    @override_settings(ESCHOL_ISSUE_FANOUT=False)
+    @mock.patch('plugins.eschol.logic.send_article')
+    def test_publish_issue_task_resume(self, mock_send):
+        article2 = helpers.create_article(self.journal,
+                                          with_author=False,
+                                          date_published=self.article.date_published,
+                                          stage=STAGE_PUBLISHED,
+                                          language=None)
+        self.issue.articles.add(article2)
+        # a publication whose worker died after the first article
+        ipub = IssuePublicationHistory.objects.create(issue=self.issue,
+                                                      success=True,
+                                                      result="No cover image",
+                                                      total_articles=2)
+        ArticlePublicationHistory.objects.create(article=self.article,
+                                                 issue_pub=ipub,
+                                                 success=True)
+        IssuePublicationHistory.objects.filter(pk=ipub.pk).update(date=datetime(2023, 1, 1))
+        self.assertEqual(ipub.result_text(), "Publication in process: 1 of 2 articles")
+
+        mock_send.side_effect = lambda a, *args, **kwargs: \
+            ArticlePublicationHistory.objects.create(article=a, success=True)
+        publish_issue_task(self.issue.pk)
+
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(mock_send.call_args[0][0], article2)
+        self.assertEqual(IssuePublicationHistory.objects.filter(issue=self.issue).count(), 1)
+        ipub.refresh_from_db()
+        self.assertTrue(ipub.is_complete)
+        self.assertTrue(ipub.success)
+        self.assertEqual(ipub.attempts, 2)
+        self.assertEqual(ipub.result, "No cover image")
+        self.assertEqual(ipub.result_text(), "Successfully published 2 of 2 articles")
+
+    @override_settings(ESCHOL_ISSUE_FANOUT=False)
+    @mock.patch('plugins.eschol.logic.send_article')
+    def test_publish_issue_task_rescheduled(self, mock_send):
+        mock_send.return_value = ArticlePublicationHistory.objects.create(article=self.article,
+                                                                          success=True)
+        # deferred after the API asked us to back off
+        ipub = IssuePublicationHistory.objects.create(issue=self.issue, total_articles=1)
+        publish_issue_task(self.issue.pk, resume_id=ipub.pk, deferrals=1)
+
+        ipub.refresh_from_db()
+        self.assertTrue(ipub.is_complete)
+        self.assertTrue(ipub.success)
+        self.assertEqual(ipub.attempts, 1)
+
+    @override_settings(ESCHOL_ISSUE_FANOUT=False, ESCHOL_ISSUE_MAX_ATTEMPTS=1)
+    @mock.patch('plugins.eschol.logic.send_article')
+    def test_publish_issue_task_max_attempts(self, mock_send):
+        mock_send.return_value = ArticlePublicationHistory.objects.create(article=self.article,
+                                                                          success=True)
+        stale = IssuePublicationHistory.objects.create(issue=self.issue, total_articles=1)
+        IssuePublicationHistory.objects.filter(pk=stale.pk).update(date=datetime(2023, 1, 1))
+        publish_issue_task(self.issue.pk)
+
+        stale.refresh_from_db()
+        self.assertTrue(stale.is_complete)
+        self.assertFalse(stale.success)
+        self.assertEqual(IssuePublicationHistory.objects.filter(issue=self.issue).count(), 2)
+
+    @mock.patch('plugins.eschol.views.async_task')
+    @mock.patch('plugins.eschol.logic.send_article')
+    def test_publish_issue_task_fanout(self, mock_send, mock_async):
+        article2 = helpers.create_article(self.journal,
+                                          with_author=False,
+                                          date_published=self.article.date_published,
+                                          stage=STAGE_PUBLISHED,
+                                          language=None)
+        self.issue.articles.add(article2)
+        apubs = {self.article.pk: ArticlePublicationHistory.objects.create(article=self.article,
+                                                                           success=True),
+                 article2.pk: ArticlePublicationHistory.objects.create(article=article2,
+                                                                       success=True)}
+        mock_send.side_effect = lambda a, *args, **kwargs: apubs[a.pk]
+
+        queued = []
+        mock_async.side_effect = lambda func, *args, **kwargs: queued.append((func, args, kwargs))
+
+        result = publish_issue_task(self.issue.pk)
+        ipub = IssuePublicationHistory.objects.get(issue=self.issue)
+        self.assertEqual(result, f"{self.issue} publication queued: 2 articles")
+        self.assertEqual(len(queued), 2)
+        self.assertEqual(ipub.total_articles, 2)
+        self.assertFalse(ipub.is_complete)
+
+        # run the first task, the issue shouldn't be finalized until both are done
+        func, args, kwargs = queued[0]
+        self.assertEqual(kwargs["group"], f"eschol_issue_{ipub.pk}")
+        self.assertEqual(kwargs["order"],
+                         logic.get_issue_ordering(self.issue)["articles"][args[1]])
+        func(*args)
+        kwargs["hook"](mock.Mock(args=args, success=True))
+        ipub.refresh_from_db()
+        self.assertFalse(ipub.is_complete)
+
+        # the second task dies so the hook records the failure
+        func, args, kwargs = queued[1]
+        kwargs["hook"](mock.Mock(args=args, success=False, result="Task exceeded timeout"))
+        ipub.refresh_from_db()
+        self.assertTrue(ipub.is_complete)
+        self.assertFalse(ipub.success)
+        self.assertEqual(ipub.articlepublicationhistory_set.count(), 2)
+        self.assertEqual(ipub.articlepublicationhistory_set.filter(success=True).count(), 1)
+
+    @mock.patch('plugins.eschol.logic.publish_issue_article')
+    def test_publish_issue_article_task_deferred(self, mock_publish):
+        ipub = IssuePublicationHistory.objects.create(issue=self.issue, total_articles=1)
+        deferring = []
+        def publish(*args):
+            deferring.append(retry.is_deferring())
+            raise retry.RetryDeferred(30, "HTTP 429")
+        mock_publish.side_effect = publish
+
+        result = publish_issue_article_task(ipub.pk, self.article.pk)
+        self.assertEqual(result, f"Article {self.article.pk} deferred: "
+                                 "eScholarship API HTTP 429, retry in 30.0s")
+        schedule = Schedule.objects.get()
+        self.assertEqual(schedule.func, "plugins.eschol.views.publish_issue_article_task")
+        self.assertEqual(schedule.args, repr((ipub.pk, self.article.pk)))
+        self.assertEqual(schedule.kwargs, "force=False, deferrals=1, order=None")
+        self.assertEqual(schedule.schedule_type, Schedule.ONCE)
+        self.assertGreater(schedule.next_run, timezone.now())
+        ipub.refresh_from_db()
+        self.assertIsNotNone(ipub.last_checkpoint)
+        self.assertFalse(ipub.is_complete)
+
+        # stop deferring once the task has been rescheduled too often
+        with override_settings(ESCHOL_RETRY_MAX_DEFERRALS=1):
+            publish_issue_article_task(ipub.pk, self.article.pk, deferrals=1)
+        self.assertEqual(deferring, [True, False])
+
     # not sure how to get the settings right to make this work in test env
     # @override_settings(URL_CONFIG="domain")
     # def test_publish_issue(self):
@@ -135,6 +273,137 @@ class TestViews(TestCase):
         response = self.client.get(url, SERVER_NAME=self.journal.domain)
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(URL_CONFIG="domain")
+    def test_access_file_signed(self):
+        f = SimpleUploadedFile(
+            "test.pdf",
+            b"\x00\x01\x02\x03",
+        )
+        tf = self.create_file(self.article, f, "Test File 1")
+        url = reverse('access_article_file', kwargs={'article_id': self.article.pk,
+                                                     'file_id': tf.pk})
+        access = logic.sign_file_access(self.article.pk, tf.pk)
+        response = self.client.get(f"{url}?access={access}", SERVER_NAME=self.journal.domain)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AccessToken.objects.count(), 0)
+
+        # signed for another file
+        access = logic.sign_file_access(self.article.pk, tf.pk + 1)
+        response = self.client.get(f"{url}?access={access}", SERVER_NAME=self.journal.domain)
+        self.assertEqual(response.status_code, 403)
+
+        # expired
+        access = logic.sign_file_access(self.article.pk, tf.pk, expires=int(time.time()) - 1)
+        response = self.client.get(f"{url}?access={access}", SERVER_NAME=self.journal.domain)
+        self.assertEqual(response.status_code, 403)
+
+        # tampered expiry
+        expires, signature = logic.sign_file_access(self.article.pk, tf.pk).split(".")
+        access = f"{int(expires) + 1}.{signature}"
+        response = self.client.get(f"{url}?access={access}", SERVER_NAME=self.journal.domain)
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(URL_CONFIG="domain", ESCHOL_VIEW_QUERY_BUDGET=1)
+    def test_access_file_query_budget(self):
+        f = SimpleUploadedFile(
+            "test.pdf",
+            b"\x00\x01\x02\x03",
+        )
+        tf = self.create_file(self.article, f, "Test File 1")
+        url = reverse('access_article_file', kwargs={'article_id': self.article.pk,
+                                                     'file_id': tf.pk})
+        access = logic.sign_file_access(self.article.pk, tf.pk)
+        with mock.patch.object(logic.logger, "warning") as mock_warning:
+            response = self.client.get(f"{url}?access={access}", SERVER_NAME=self.journal.domain)
+        self.assertEqual(response.status_code, 200)
+        # the article and the file
+        mock_warning.assert_called_once()
+        self.assertTrue(mock_warning.call_args[0][0]
+                        .startswith("access_article_file view ran 2 queries"))
+
+    @override_settings(URL_CONFIG="domain")
+    def test_access_file_expired_token(self):
+        f = SimpleUploadedFile(
+            "test.pdf",
+            b"\x00\x01\x02\x03",
+        )
+        tf = self.create_file(self.article, f, "Test File 1")
+        t = AccessToken.objects.create(token="abc", article_id=self.article.pk, file_id=tf.pk)
+        AccessToken.objects.filter(pk=t.pk).update(date=datetime(2023, 1, 1))
+        url = reverse('access_article_file', kwargs={'article_id': self.article.pk,
+                                                     'file_id': tf.pk}) + f"?access={t.token}"
+        response = self.client.get(url, SERVER_NAME=self.journal.domain)
+        self.assertEqual(response.status_code, 403)
+        # the view no longer deletes expired tokens
+        self.assertTrue(AccessToken.objects.filter(pk=t.pk).exists())
+
+    def test_purge_expired_access_tokens(self):
+        for i in range(5):
+            AccessToken.objects.create(token=f"old{i}", article_id=self.article.pk, file_id=i)
+        AccessToken.objects.update(date=datetime(2023, 1, 1))
+        AccessToken.objects.create(token="new", article_id=self.article.pk, file_id=1)
+
+        self.assertEqual(logic.purge_expired_access_tokens(batch_size=2), 5)
+        self.assertEqual(list(AccessToken.objects.values_list("token", flat=True)), ["new"])
+
+    @override_settings(URL_CONFIG="domain")
+    def test_access_file_conditional(self):
+        f = SimpleUploadedFile(
+            "test.pdf",
+            b"\x00\x01\x02\x03",
+        )
+        tf = self.create_file(self.article, f, "Test File 1")
+        url = reverse('access_article_file', kwargs={'article_id': self.article.pk,
+                                                     'file_id': tf.pk})
+        url += f"?access={logic.sign_file_access(self.article.pk, tf.pk)}"
+        response = self.client.get(url, SERVER_NAME=self.journal.domain)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        stat = os.stat(logic.get_file_path(tf))
+        self.assertEqual(etag, f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"')
+
+        response = self.client.get(url, SERVER_NAME=self.journal.domain, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url,
+                                   SERVER_NAME=self.journal.domain,
+                                   HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url, SERVER_NAME=self.journal.domain, HTTP_RANGE="bytes=1-2")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 1-2/4")
+        self.assertEqual(b"".join(response.streaming_content), b"\x01\x02")
+
+        response = self.client.get(url, SERVER_NAME=self.journal.domain, HTTP_RANGE="bytes=-1")
+        self.assertEqual(b"".join(response.streaming_content), b"\x03")
+
+        response = self.client.get(url, SERVER_NAME=self.journal.domain, HTTP_RANGE="bytes=4-")
+        self.assertEqual(response.status_code, 416)
+
+        # the file changed since the client's copy, send all of it
+        response = self.client.get(url,
+                                   SERVER_NAME=self.journal.domain,
+                                   HTTP_RANGE="bytes=1-2",
+                                   HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(URL_CONFIG="domain", ESCHOL_X_ACCEL_REDIRECT_PREFIX="/protected/")
+    def test_access_file_x_accel_redirect(self):
+        f = SimpleUploadedFile(
+            "test.pdf",
+            b"\x00\x01\x02\x03",
+        )
+        tf = self.create_file(self.article, f, "Test File 1")
+        url = reverse('access_article_file', kwargs={'article_id': self.article.pk,
+                                                     'file_id': tf.pk})
+        url += f"?access={logic.sign_file_access(self.article.pk, tf.pk)}"
+        response = self.client.get(url, SERVER_NAME=self.journal.domain)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"],
+                         f"/protected/articles/{self.article.pk}/{tf.uuid_filename}")
+        self.assertEqual(response.content, b"")
+
     def test_access_file_file_missing(self):
         f = File.objects.create(article_id=self.article.pk,
                                 label="file",
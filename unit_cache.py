@@ -0,0 +1,108 @@
+import threading, time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from plugins.eschol.models import JournalUnit
+
+from utils.logger import get_logger
+logger = get_logger(__name__)
+
+# JournalUnit rows are looked up for every deposited article and rarely change
+# so they are cached by journal id.  By default each process keeps its own copy
+# for ESCHOL_JOURNAL_UNIT_CACHE_TTL seconds.  Set ESCHOL_JOURNAL_UNIT_CACHE to a
+# django cache alias to share the cache between workers, in which case saving
+# or deleting a JournalUnit invalidates it everywhere.
+CACHE_PREFIX = "eschol_journal_unit"
+NO_UNIT = "none"
+
+_local = {}
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def get_backend():
+    alias = getattr(settings, "ESCHOL_JOURNAL_UNIT_CACHE", None)
+    return caches[alias] if alias else None
+
+def get_ttl():
+    return getattr(settings, "ESCHOL_JOURNAL_UNIT_CACHE_TTL", 300)
+
+def cache_key(journal_id):
+    return f"{CACHE_PREFIX}_{journal_id}"
+
+def count(stat):
+    with _lock:
+        _stats[stat] += 1
+
+def get_cached(journal_id):
+    backend = get_backend()
+    if backend:
+        return backend.get(cache_key(journal_id))
+    with _lock:
+        entry = _local.get(journal_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def set_cached(journal_id, value):
+    backend = get_backend()
+    if backend:
+        backend.set(cache_key(journal_id), value, get_ttl())
+    else:
+        with _lock:
+            _local[journal_id] = (time.monotonic() + get_ttl(), value)
+
+def get_journal_unit(journal):
+    """Returns (unit, default_css_url) for a journal, or None if it has no JournalUnit"""
+    value = get_cached(journal.pk)
+    if value is not None:
+        count("hits")
+        return None if value == NO_UNIT else value
+
+    count("misses")
+    ju = JournalUnit.objects.filter(journal=journal).first()
+    value = (ju.unit, ju.default_css_url) if ju else NO_UNIT
+    set_cached(journal.pk, value)
+    return None if value == NO_UNIT else value
+
+def invalidate(journal_id):
+    if journal_id is None:
+        return
+    backend = get_backend()
+    if backend:
+        backend.delete(cache_key(journal_id))
+    with _lock:
+        _local.pop(journal_id, None)
+        _stats["invalidations"] += 1
+    logger.debug(f"JournalUnit cache invalidated for journal {journal_id}")
+
+def clear():
+    """Empties this process's cache and resets its stats"""
+    with _lock:
+        _local.clear()
+        for k in _stats:
+            _stats[k] = 0
+
+def stats():
+    with _lock:
+        s = dict(_stats)
+        s["size"] = len(_local)
+    s["backend"] = getattr(settings, "ESCHOL_JOURNAL_UNIT_CACHE", None) or "local"
+    return s
+
+@receiver(pre_save, sender=JournalUnit)
+def invalidate_previous_journal(sender, instance, **kwargs): # pylint: disable=unused-argument
+    # the unit may be moved to a different journal
+    if instance.pk:
+        old = JournalUnit.objects.filter(pk=instance.pk)\
+                                 .values_list("journal_id", flat=True)\
+                                 .first()
+        if old != instance.journal_id:
+            invalidate(old)
+
+@receiver(post_save, sender=JournalUnit)
+@receiver(post_delete, sender=JournalUnit)
+def invalidate_journal(sender, instance, **kwargs): # pylint: disable=unused-argument
+    invalidate(instance.journal_id)
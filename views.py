@@ -1,60 +1,205 @@
 from datetime import datetime, timedelta
+from functools import wraps
 
 from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponseForbidden
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
+from django.db.models import Prefetch, Q
+from django.utils import timezone
 
 from django_q.tasks import async_task
+from django_q.models import Schedule
 
 from submission.models import Article
 from journal.models import Issue
 from core.models import File
-from core import files
 
-from .models import AccessToken, IssuePublicationHistory
+from .models import AccessToken, ArticlePublicationHistory, IssuePublicationHistory
 
+from . import circuit, downloads, logic, metrics, retry, unit_cache
 from .logic import article_to_eschol, issue_to_eschol
 from .plugin_settings import PLUGIN_NAME
 
-def publish_issue_task(issue_id):
+def query_budget(view):
+    """Logs the queries a view runs, including rendering its template, with a
+    warning if there are more than ESCHOL_VIEW_QUERY_BUDGET"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with metrics.collecting() as values, metrics.counting_queries():
+            response = view(request, *args, **kwargs)
+        logic.check_query_budget(f"{view.__name__} view",
+                                 values.get("queries"),
+                                 values.get("query_time"),
+                                 getattr(settings, "ESCHOL_VIEW_QUERY_BUDGET", None))
+        return response
+    return wrapper
+
+def defer_task(func, delay, args, kwargs, hook=None):
+    """Schedules a task to run again once the eScholarship API has had time to recover"""
+    Schedule.objects.create(func=f"{func.__module__}.{func.__name__}",
+                            args=repr(tuple(args)),
+                            kwargs=", ".join([f"{k}={v!r}" for k, v in kwargs.items()]),
+                            hook=hook,
+                            schedule_type=Schedule.ONCE,
+                            next_run=timezone.now() + timedelta(seconds=delay))
+
+def can_defer(deferrals):
+    return deferrals < getattr(settings, "ESCHOL_RETRY_MAX_DEFERRALS", 5)
+
+def publish_issue_article_task(ipub_id, article_id, force=False, deferrals=0, order=None):
+    try:
+        with retry.deferring(can_defer(deferrals)):
+            apub = logic.publish_issue_article(ipub_id, article_id, force, order)
+    except retry.RetryDeferred as e:
+        defer_task(publish_issue_article_task,
+                   e.delay,
+                   (ipub_id, article_id),
+                   {"force": force, "deferrals": deferrals + 1, "order": order},
+                   hook=f"{__name__}.publish_issue_article_hook")
+        # the publication is still making progress
+        IssuePublicationHistory.objects.filter(pk=ipub_id).update(last_checkpoint=timezone.now())
+        return f"Article {article_id} deferred: {e}"
+    return str(apub)
+
+def publish_issue_article_hook(task):
+    ipub_id, article_id = task.args[0], task.args[1]
+    if not task.success:
+        msg = f"Publication task for article {article_id} failed: {task.result}"
+        logic.record_issue_article_failure(ipub_id, article_id, msg)
+    logic.finalize_issue_publication(ipub_id)
+
+def queue_issue_articles(issue, force=False, incremental=False, ipub=None):
+    """Queues one task per article in a django_q group, the task hook finalizes the issue.
+
+    If `ipub` is an incomplete publication being resumed only the articles
+    without a result are queued.
+    """
+    # the state of every article is compared in incremental mode, prefetch what it needs
+    articles = logic.get_issue_articles(issue) if incremental else list(issue.get_sorted_articles())
+    configured = logic.is_configured()
+    if ipub is None or ipub.total_articles is None:
+        ipub = logic.start_issue_publication(issue, len(articles), configured, force, ipub)
+    articles = logic.get_unsent_articles(ipub, articles)
+    # built once here so each task doesn't have to look up its article's order
+    ordering = logic.get_issue_ordering(issue)
+    if incremental:
+        articles, not_modified = logic.split_modified_articles(articles, ordering)
+        for a, state_digest in not_modified:
+            logic.not_modified_article(a, None, state_digest, issue_pub=ipub)
+    article_ids = [a.pk for a in articles]
+    if configured:
+        logic.premint_arks(articles)
+    group = f"eschol_issue_{ipub.pk}"
+    for article_id in article_ids:
+        async_task(publish_issue_article_task,
+                   ipub.pk,
+                   article_id,
+                   force=force,
+                   order=ordering["articles"].get(article_id),
+                   group=group,
+                   hook=publish_issue_article_hook)
+
+    if not article_ids:
+        logic.finalize_issue_publication(ipub.pk)
+
+    if incremental:
+        return f"{issue} publication queued: {len(article_ids)} of {ipub.total_articles} articles"
+
+    return f"{issue} publication queued: {len(article_ids)} articles"
+
+def publish_issue_task(issue_id, force=False, incremental=False, resume_id=None, deferrals=0):
     issue = Issue.objects.get(pk=issue_id)
 
-    # Mark complete and unsuccessful any issue publication
-    # attempts that have timed out
+    if resume_id:
+        # rescheduled after the API asked us to back off
+        resume = IssuePublicationHistory.objects.filter(pk=resume_id, is_complete=False).first()
+        if not resume:
+            return f"{issue} publication {resume_id} already complete"
+        return run_issue_publication(issue, force, incremental, resume, deferrals,
+                                     new_attempt=False)
+
+    # Issue publication attempts that have made no progress within the
+    # retry time have timed out.  The most recent is resumed from its last
+    # checkpoint unless it has used up ESCHOL_ISSUE_MAX_ATTEMPTS, the rest
+    # are marked complete and unsuccessful
     q_settings = getattr(settings, 'DJANGO_Q', {})
     delta = timedelta(seconds=q_settings.get("retry", 400))
     timeout = datetime.now() - delta
     objs = IssuePublicationHistory.objects.filter(
         issue=issue,
         is_complete=False,
-        date__lt=timeout
-    )
+    ).filter(Q(last_checkpoint__lt=timeout) | Q(last_checkpoint=None, date__lt=timeout))
+    max_attempts = getattr(settings, "ESCHOL_ISSUE_MAX_ATTEMPTS", 3)
+    resume = None
     for h in objs:
+        if resume is None and h.attempts < max_attempts:
+            resume = h
+            continue
         h.is_complete = True
         h.success = False
         h.save()
 
-    if not IssuePublicationHistory.objects.filter(issue=issue, is_complete=False).exists():
-        ipub = issue_to_eschol(issue=issue)
-        return str(ipub)
+    in_process = IssuePublicationHistory.objects.filter(issue=issue, is_complete=False)
+    if resume:
+        in_process = in_process.exclude(pk=resume.pk)
+    if not in_process.exists():
+        return run_issue_publication(issue, force, incremental, resume, deferrals)
 
     return f"{issue} publication in process"
 
+def run_issue_publication(issue, force=False, incremental=False, resume=None, deferrals=0,
+                          new_attempt=True):
+    """Publishes the issue, resuming `resume` if given.
+
+    Backing off when the API asks us to isn't a new attempt, a rescheduled
+    publication is only checkpointed so it doesn't use up ESCHOL_ISSUE_MAX_ATTEMPTS.
+    """
+    if resume and new_attempt:
+        logic.resume_issue_publication(resume)
+    elif resume:
+        logic.checkpoint_issue_publication(resume)
+    try:
+        with retry.deferring(can_defer(deferrals)):
+            if getattr(settings, "ESCHOL_ISSUE_FANOUT", True):
+                return queue_issue_articles(issue, force, incremental, resume)
+            ipub = issue_to_eschol(issue=issue, force=force, incremental=incremental, ipub=resume)
+            return str(ipub)
+    except retry.RetryDeferred as e:
+        ipub = IssuePublicationHistory.objects.filter(issue=issue, is_complete=False).first()
+        defer_task(publish_issue_task,
+                   e.delay,
+                   (issue.pk,),
+                   {"force": force,
+                    "incremental": incremental,
+                    "resume_id": ipub.pk if ipub else None,
+                    "deferrals": deferrals + 1})
+        return f"{issue} publication deferred: {e}"
+
 @login_required
+@query_budget
 def publish_issue(request, issue_id):
     template = 'eschol/issue_publish_queued.html'
     issue = get_object_or_404(Issue, pk=issue_id)
-    async_task(publish_issue_task, issue_id, group=issue_id)
+    force = "force" in request.GET
+    incremental = "incremental" in request.GET
+    async_task(publish_issue_task,
+               issue_id,
+               force=force,
+               incremental=incremental,
+               group=issue_id)
     context = {'plugin_name': PLUGIN_NAME,
                'issue': issue}
     return render(request, template, context)
 
 @login_required
+@query_budget
 def publish_article(request, article_id):
     template = 'eschol/published.html'
     article = get_object_or_404(Article, pk=article_id)
-    pub_history  = article_to_eschol(request=request, article=article)
+    pub_history  = article_to_eschol(request=request,
+                                     article=article,
+                                     force="force" in request.GET)
     context = {
         'plugin_name': PLUGIN_NAME,
         'obj': article,
@@ -65,19 +210,30 @@ def publish_article(request, article_id):
     return render(request, template, context)
 
 @login_required
+@query_budget
 def list_articles(request, issue_id):
     template = 'eschol/list_articles.html'
     issue = get_object_or_404(Issue, pk=issue_id)
+    pub_history = issue.issuepublicationhistory_set.all().order_by('-date')[:10]
+    articles = issue.get_sorted_articles().select_related('journal')\
+                                          .prefetch_related('escholarticle_set')
+    if pub_history:
+        # timings of each article in the latest issue publication
+        latest = ArticlePublicationHistory.objects.filter(issue_pub=pub_history[0])
+        articles = articles.prefetch_related(Prefetch('articlepublicationhistory_set',
+                                                      queryset=latest,
+                                                      to_attr='latest_pubs'))
     context = {
         'plugin_name': PLUGIN_NAME,
         'issue': issue,
-        'articles': issue.get_sorted_articles(),
-        'pub_history': issue.issuepublicationhistory_set.all().order_by('-date')[:10]
+        'articles': articles,
+        'pub_history': pub_history
     }
 
     return render(request, template, context)
 
 @login_required
+@query_budget
 def eschol_manager(request):
     template = 'eschol/manager.html'
     if request.journal:
@@ -87,20 +243,28 @@ def eschol_manager(request):
 
     context = {
         'plugin_name': PLUGIN_NAME,
-        'issues': issues
+        'issues': issues,
+        'unit_cache_stats': unit_cache.stats(),
+        'circuit_stats': circuit.stats(),
     }
 
     return render(request, template, context)
 
+@query_budget
 def access_article_file(request, article_id, file_id):
     if not "access" in request.GET:
         return HttpResponseForbidden()
 
     token = request.GET.get("access")
-    AccessToken.objects.filter(date__lt=datetime.now()-timedelta(days=1)).delete()
-    if not AccessToken.objects.filter(article_id=article_id, file_id=file_id, token=token).exists():
-        return HttpResponseForbidden()
+    if not logic.check_file_access(article_id, file_id, token):
+        # links from before signed links were introduced
+        # expired tokens are purged by purge_expired_access_tokens
+        if not AccessToken.objects.filter(article_id=article_id,
+                                          file_id=file_id,
+                                          token=token,
+                                          date__gte=logic.get_access_token_cutoff()).exists():
+            return HttpResponseForbidden()
 
     article_object = get_object_or_404(Article, pk=article_id)
     file_object = get_object_or_404(File, pk=file_id)
-    return files.serve_file(request, file_object, article_object)
+    return downloads.serve_article_file(request, article_object, file_object)